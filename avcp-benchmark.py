@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+
+
+'''Benchmark for portaletrasparenza-avcp-scraper.py, that does not need to contact the
+   http://portaletrasparenza.avcp.it website. Synthetic monthly export files are generated
+   with the same lotto/strutturaProponente/aggiudicatari/aggiudicatarioRaggruppamento/membro
+   structure of the files published by the portal, and they are served by a local
+   stand-in HTTP server.
+   Usage:
+      avcp-benchmark.py generate (to generate the synthetic monthly files in the directory)
+      avcp-benchmark.py run (to time download, extract, indent, dump_all_winners and the
+                             freeze export on synthetic data, and then the search of a few
+                             queries on the extracted database)
+   Options:
+      --directory=DIR (where the files are generated, default a new temporary directory)
+      --years=N (number of years of data, default 1)
+      --lots=N (number of lots in each month, default 2000)
+      --agencies=N (number of distinct public agencies, default 500)
+      --vendors=N (number of distinct vendors, default 5000)
+      --foreign_ratio=R (fraction of winners that are foreign vendors, default 0.05)
+      --consortium_ratio=R (fraction of lots won by a consortium, default 0.1)
+      --name_variant_ratio=R (fraction of agency and vendor names spelled differently, default 0.1)
+      --seed=N (seed of the random generator, default 1)
+      --extract_processes=N (passed to the scraper, default 1)
+      --compress=gzip|zstd (passed to the scraper, default plain xml)
+      --search_limit=SECONDS (most seconds for the search of a lot number, default 0.5; the
+                              benchmark fails if a search is slower)
+      --report=FILE (also write the results as json to FILE)
+      --verbose (show the output of the scraper)
+'''
+
+
+import os
+import sys
+import getopt
+import imp
+import json
+import random
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import time
+import traceback
+import urlparse
+import BaseHTTPServer
+import SocketServer
+import xml.sax.saxutils
+
+scraper_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),"portaletrasparenza-avcp-scraper.py")
+freeze_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),"openspending_freeze.yaml")
+
+first_year = 2011
+years = 1
+lots_per_month = 2000
+agencies_count = 500
+vendors_count = 5000
+foreign_ratio = 0.05
+consortium_ratio = 0.1
+name_variant_ratio = 0.1
+seed = 1
+extract_processes = 1
+compression = None
+directory = None
+report_filename = None
+verbose = False
+search_limit = 0.5
+#each search query is timed SEARCH_REPEATS times, keeping the best time
+SEARCH_REPEATS = 3
+
+SCELTA_CONTRAENTE = [
+    u"01-PROCEDURA APERTA",
+    u"02-PROCEDURA RISTRETTA",
+    u"04-PROCEDURA NEGOZIATA SENZA PREVIA PUBBLICAZIONE DEL BANDO",
+    u"08-AFFIDAMENTO IN ECONOMIA - COTTIMO FIDUCIARIO",
+    u"23-AFFIDAMENTO IN ECONOMIA - AFFIDAMENTO DIRETTO",
+    u"26-AFFIDAMENTO DIRETTO IN ADESIONE AD ACCORDO QUADRO/CONVENZIONE",
+]
+RUOLI = [u"01-MANDANTE", u"02-MANDATARIA", u"03-ASSOCIATA", u"04-CAPOGRUPPO", u"05-CONSORZIATA"]
+AGENCY_KINDS = [u"COMUNE DI", u"PROVINCIA DI", u"AZIENDA SANITARIA LOCALE", u"UNIVERSITA' DEGLI STUDI DI", u"ISTITUTO COMPRENSIVO"]
+PLACES = [u"ROMA", u"MILANO", u"NAPOLI", u"TORINO", u"PALERMO", u"GENOVA", u"BOLOGNA", u"FIRENZE", u"BARI", u"CATANIA",
+          u"VENEZIA", u"VERONA", u"MESSINA", u"PADOVA", u"TRIESTE", u"BRESCIA", u"PARMA", u"TARANTO", u"PRATO", u"MODENA"]
+VENDOR_WORDS = [u"EDILIZIA", u"COSTRUZIONI", u"SERVIZI", u"FORNITURE", u"IMPIANTI", u"INFORMATICA", u"ECOLOGIA",
+                u"TRASPORTI", u"MANUTENZIONI", u"SISTEMI", u"CONSULTING", u"GLOBAL", u"NORD", u"SUD", u"ITALIA"]
+LEGAL_FORMS = [u"S.R.L.", u"SRL", u"S.P.A.", u"SPA", u"SOCIETA' COOPERATIVA", u"S.N.C.", u"S.A.S."]
+OGGETTI = [u"Fornitura di materiale di cancelleria", u"Servizio di pulizia degli uffici", u"Lavori di manutenzione straordinaria",
+           u"Servizio di mensa scolastica", u"Fornitura di energia elettrica", u"Noleggio di fotocopiatrici",
+           u"Servizio di manutenzione del verde pubblico", u"Acquisto di licenze software"]
+
+def name_variant(name,random_generator):
+    '''A different spelling of a name, like the ones found in the portal data'''
+    variant = random_generator.randint(0,3)
+    if( variant == 0 ):
+        return name.lower()
+    if( variant == 1 ):
+        return name.replace(u"S.R.L.",u"SRL").replace(u"S.P.A.",u"SPA") + u" "
+    if( variant == 2 ):
+        return name.replace(u" ",u"  ",1)
+    return name.title()
+
+def generate_entities(random_generator):
+    '''Generate the public agencies and vendors used by all the months'''
+    agencies = []
+    for i in range(agencies_count):
+        code = u"%011d" % (80000000000+i)
+        name = random_generator.choice(AGENCY_KINDS) + u" " + random_generator.choice(PLACES)
+        agencies.append((code,name))
+    vendors = []
+    for i in range(vendors_count):
+        if( random_generator.random() < 0.2 ):
+            #individual vendor, identified by a codice fiscale
+            code = u"RSSMRA%02dA01H%03dX" % (i % 100,i % 1000)
+        else:
+            code = u"%011d" % (1000000000+i)
+        name = random_generator.choice(VENDOR_WORDS) + u" " + random_generator.choice(VENDOR_WORDS) + u" " + random_generator.choice(LEGAL_FORMS)
+        vendors.append((code,name))
+    return agencies, vendors
+
+def vendor_element(tag,vendor,random_generator,role=None):
+    '''Xml of an aggiudicatario or membro element'''
+    code, name = vendor
+    if( random_generator.random() < name_variant_ratio ):
+        name = name_variant(name,random_generator)
+    xml_data = u"<" + tag + u">"
+    if( random_generator.random() < foreign_ratio ):
+        xml_data = xml_data + u"<identificativoFiscaleEstero>FR" + code[-9:] + u"</identificativoFiscaleEstero>"
+    else:
+        xml_data = xml_data + u"<codiceFiscale>" + code + u"</codiceFiscale>"
+    xml_data = xml_data + u"<ragioneSociale>" + xml.sax.saxutils.escape(name) + u"</ragioneSociale>"
+    if( role is not None ):
+        xml_data = xml_data + u"<ruolo>" + role + u"</ruolo>"
+    return xml_data + u"</" + tag + u">"
+
+def generate_month(filename,year,month,agencies,vendors,random_generator):
+    '''Write a synthetic monthly export file, returning its number of lots'''
+    with open(filename,'wb',1024*1024) as f:
+        f.write(b'<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write(b'<legge190:pubblicazione xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xmlns:legge190="legge190_1_0">')
+        f.write(b'<metadata><titolo>Pubblicazione 1 legge 190</titolo><abstract>Pubblicazione 1 legge 190 anno ' + str(year).encode('ascii') + b'</abstract>')
+        f.write(b'<entePubblicatore>AVCP</entePubblicatore><licenza>IODL</licenza></metadata><data>')
+        for lot in range(lots_per_month):
+            agency_code, agency_name = random_generator.choice(agencies)
+            if( random_generator.random() < name_variant_ratio ):
+                agency_name = name_variant(agency_name,random_generator)
+            cig = u"%010X" % random_generator.getrandbits(40)
+            amount = random_generator.randint(100,2000000)
+            xml_data = u"<lotto><cig>" + cig + u"</cig><strutturaProponente><codiceFiscaleProp>" + agency_code + u"</codiceFiscaleProp>"
+            xml_data = xml_data + u"<denominazione>" + xml.sax.saxutils.escape(agency_name) + u"</denominazione></strutturaProponente>"
+            xml_data = xml_data + u"<oggetto>" + xml.sax.saxutils.escape(random_generator.choice(OGGETTI)) + u" - lotto " + str(lot) + u"</oggetto>"
+            xml_data = xml_data + u"<sceltaContraente>" + random_generator.choice(SCELTA_CONTRAENTE) + u"</sceltaContraente>"
+            xml_data = xml_data + u"<partecipanti>"
+            for i in range(random_generator.randint(1,3)):
+                xml_data = xml_data + vendor_element(u"partecipante",random_generator.choice(vendors),random_generator)
+            xml_data = xml_data + u"</partecipanti><aggiudicatari>"
+            kind = random_generator.random()
+            if( kind < consortium_ratio ):
+                xml_data = xml_data + u"<aggiudicatarioRaggruppamento>"
+                for vendor in random_generator.sample(vendors,random_generator.randint(2,4)):
+                    xml_data = xml_data + vendor_element(u"membro",vendor,random_generator,random_generator.choice(RUOLI))
+                xml_data = xml_data + u"</aggiudicatarioRaggruppamento>"
+            elif( kind < 0.95 ):
+                xml_data = xml_data + vendor_element(u"aggiudicatario",random_generator.choice(vendors),random_generator)
+            xml_data = xml_data + u"</aggiudicatari><importoAggiudicazione>" + u"%d.%02d" % (amount,random_generator.randint(0,99)) + u"</importoAggiudicazione>"
+            xml_data = xml_data + u"<tempiCompletamento><dataInizio>" + u"%d-%02d-01" % (year,month) + u"</dataInizio></tempiCompletamento>"
+            xml_data = xml_data + u"<importoSommeLiquidate>" + u"%d.00" % random_generator.randint(0,amount) + u"</importoSommeLiquidate></lotto>"
+            f.write(xml_data.encode('utf-8'))
+        f.write(b'</data></legge190:pubblicazione>')
+    return lots_per_month
+
+def generate_data(scraper,data_directory):
+    '''Generate the synthetic monthly files of closed tenders in data_directory, as plain xml
+       named as the scraper names them. Returns the total number of lots and bytes generated'''
+    random_generator = random.Random(seed)
+    agencies, vendors = generate_entities(random_generator)
+    total_lots = 0
+    total_bytes = 0
+    for year in scraper.years_to_download:
+        for month in scraper.months_in_a_year:
+            filename = os.path.join(data_directory,scraper.xml_filename(year,month))
+            print("Generating " + filename)
+            total_lots = total_lots + generate_month(filename,year,month,agencies,vendors,random_generator)
+            total_bytes = total_bytes + os.path.getsize(filename)
+    return total_lots, total_bytes
+
+class PortalStandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Answer the export_xml.aspx requests of the scraper with the generated (plain xml) files'''
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+        search_key, year, month, tender_state = query['valuepromptanswers'][0].split('^')
+        filename = os.path.join(self.server.data_directory,"avcp_contracts_" + year + "_" + "%02d" % int(month) + ".xml")
+        if( tender_state != "0" or not os.path.exists(filename) ):
+            self.send_response(404)
+            self.send_header("Content-Length","0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type","text/xml")
+        self.send_header("Content-Length",str(os.path.getsize(filename)))
+        self.end_headers()
+        with open(filename,'rb') as f:
+            shutil.copyfileobj(f,self.wfile,1024*1024)
+
+    def log_message(self,format,*args):
+        return
+
+class PortalStandInServer(SocketServer.ThreadingMixIn,BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+def start_portal_stand_in(scraper,data_directory):
+    '''Start the local stand-in of the portal on a free port, returning the server and its export URL'''
+    server = PortalStandInServer(("127.0.0.1",0),PortalStandInHandler)
+    server.scraper = scraper
+    server.data_directory = data_directory
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, "http://127.0.0.1:" + str(server.server_address[1]) + "/Microstrategy/asp/export_xml.aspx"
+
+def run_freeze():
+    '''Run the datafreeze export of openspending_freeze.yaml'''
+    subprocess.check_call(["datafreeze",freeze_path])
+
+def has_datafreeze():
+    for path in os.environ.get("PATH","").split(os.pathsep):
+        if( os.path.exists(os.path.join(path,"datafreeze")) ):
+            return True
+    return False
+
+def run_stage(name,function):
+    '''Run a stage of the scraper in a child process, returning the elapsed seconds and the
+       peak resident memory of the child in MB (or None if the stage failed)'''
+    print("Running " + name)
+    start_time = time.time()
+    pid = os.fork()
+    if( pid == 0 ):
+        exit_code = 0
+        try:
+            if( not verbose ):
+                devnull = os.open(os.devnull,os.O_WRONLY)
+                os.dup2(devnull,1)
+            function()
+        except BaseException:
+            traceback.print_exc()
+            exit_code = 1
+        sys.stdout.flush()
+        os._exit(exit_code)
+    pid, status, rusage = os.wait4(pid,0)
+    seconds = time.time() - start_time
+    if( status != 0 ):
+        print("Error: stage " + name + " failed")
+        return None
+    #ru_maxrss is in KB on Linux
+    return dict(stage=name,seconds=seconds,peak_rss_mb=rusage.ru_maxrss/1024.0)
+
+def time_search(scraper):
+    '''Time full_text_search on the extracted database, returning for each query the best
+       seconds and the rows found. The queries for a lot number match only a few contracts,
+       and they have search_limit as limit'''
+    lot = str(lots_per_month//2)
+    queries = [(u"lotto " + lot,True),(u"roma lotto " + lot,True),(u"srl lotto " + lot,True),
+               (u"fornitura srl",False),(u"pulizia roma",False),(u"informatica",False)]
+    db = sqlite3.connect(scraper.database_name)
+    results = []
+    for query, selective in queries:
+        seconds = None
+        for i in range(SEARCH_REPEATS):
+            start_time = time.time()
+            rows = scraper.full_text_search(db,query)
+            elapsed = time.time() - start_time
+            if( seconds is None or elapsed < seconds ):
+                seconds = elapsed
+        results.append(dict(query=query,seconds=seconds,rows=len(rows),limit=search_limit if selective else None))
+    db.close()
+    return results
+
+def run_benchmark(scraper,data_directory):
+    '''Generate the data, then time each stage of the scraper against it'''
+    portal_directory = os.path.join(data_directory,"portal")
+    work_directory = os.path.join(data_directory,"work")
+    for path in [portal_directory,work_directory]:
+        if( not os.path.exists(path) ):
+            os.makedirs(path)
+    total_lots, total_bytes = generate_data(scraper,portal_directory)
+    server, scraper.avcp_export_url = start_portal_stand_in(scraper,portal_directory)
+    scraper.force_download = True
+    scraper.extract_processes = extract_processes
+    scraper.compression = compression
+    scraper.full_text_index = True
+    os.chdir(work_directory)
+
+    stages = [("download",scraper.download_data),
+              ("extract",scraper.extract_data),
+              ("indent",scraper.indent_data),
+              ("dump_all_winners",scraper.dump_all_winners),
+              ("export csv",scraper.export_data)]
+    if( has_datafreeze() ):
+        stages.append(("datafreeze",run_freeze))
+    scraper.export_formats = ['csv']
+
+    results = []
+    for name, function in stages:
+        result = run_stage(name,function)
+        if( result is None ):
+            continue
+        result['mb_per_second'] = total_bytes/1048576.0/max(result['seconds'],0.001)
+        result['lots_per_second'] = total_lots/max(result['seconds'],0.001)
+        results.append(result)
+    server.shutdown()
+    search_results = []
+    if( 'extract' in [result['stage'] for result in results] ):
+        print("Running search")
+        search_results = time_search(scraper)
+
+    print("")
+    print("%d months, %d lots, %.1f MB of xml" % (len(scraper.years_to_download)*len(scraper.months_in_a_year),total_lots,total_bytes/1048576.0))
+    print("%-18s %10s %10s %12s %14s" % ("stage","seconds","MB/s","lots/s","peak RSS (MB)"))
+    for result in results:
+        print("%-18s %10.2f %10.2f %12d %14.1f" % (result['stage'],result['seconds'],result['mb_per_second'],result['lots_per_second'],result['peak_rss_mb']))
+    slow_searches = [result for result in search_results if result['limit'] is not None and result['seconds'] > result['limit']]
+    if( len(search_results) > 0 ):
+        print("")
+        print("%-26s %10s %8s %10s" % ("search","seconds","rows","limit"))
+        for result in search_results:
+            limit = "" if result['limit'] is None else "%.3f" % result['limit']
+            print("%-26s %10.3f %8d %10s" % (result['query'],result['seconds'],result['rows'],limit))
+
+    if( report_filename is not None ):
+        report = dict(months=len(scraper.years_to_download)*len(scraper.months_in_a_year),lots=total_lots,xml_bytes=total_bytes,
+                      lots_per_month=lots_per_month,foreign_ratio=foreign_ratio,consortium_ratio=consortium_ratio,
+                      name_variant_ratio=name_variant_ratio,extract_processes=extract_processes,compression=compression,
+                      stages=results,search=search_results)
+        with open(report_filename,'w') as f:
+            json.dump(report,f,indent=1,sort_keys=True)
+
+    if( len(slow_searches) > 0 ):
+        print("Error: the search of " + ", ".join("'" + result['query'] + "'" for result in slow_searches) + " took more than " + str(search_limit) + " seconds")
+        sys.exit(1)
+
+def main():
+    '''Main method for the benchmark'''
+    global years, lots_per_month, agencies_count, vendors_count, foreign_ratio, consortium_ratio
+    global name_variant_ratio, seed, extract_processes, compression, directory, report_filename, verbose
+    global search_limit
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "h", ["help","directory=","years=","lots=","agencies=","vendors=",
+                                                       "foreign_ratio=","consortium_ratio=","name_variant_ratio=",
+                                                       "seed=","extract_processes=","compress=","search_limit=","report=","verbose"])
+    except getopt.error:
+        print("for help use --help")
+        sys.exit(2)
+
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            print(__doc__)
+            sys.exit(0)
+        if o == "--directory":
+            directory = os.path.abspath(a)
+        if o == "--years":
+            years = int(a)
+        if o == "--lots":
+            lots_per_month = int(a)
+        if o == "--agencies":
+            agencies_count = int(a)
+        if o == "--vendors":
+            vendors_count = int(a)
+        if o == "--foreign_ratio":
+            foreign_ratio = float(a)
+        if o == "--consortium_ratio":
+            consortium_ratio = float(a)
+        if o == "--name_variant_ratio":
+            name_variant_ratio = float(a)
+        if o == "--seed":
+            seed = int(a)
+        if o == "--extract_processes":
+            extract_processes = int(a)
+        if o == "--compress":
+            compression = a
+        if o == "--search_limit":
+            search_limit = float(a)
+        if o == "--report":
+            report_filename = os.path.abspath(a)
+        if o == "--verbose":
+            verbose = True
+
+    scraper = imp.load_source("avcp_scraper",scraper_path)
+    scraper.years_to_download = range(first_year,first_year+years)
+    if( directory is None ):
+        directory = tempfile.mkdtemp(prefix="avcp-benchmark-")
+    elif( not os.path.exists(directory) ):
+        os.makedirs(directory)
+
+    for arg in args:
+        if( arg == "generate" ):
+            generate_data(scraper,directory)
+        if( arg == "run" ):
+            run_benchmark(scraper,directory)
+
+if __name__ == "__main__":
+    main()
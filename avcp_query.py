@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+
+
+'''Read-only query service for the avcp_contracts.db database built by the extract of
+   portaletrasparenza-avcp-scraper.py. It answers the lookups of a contract by CIG and of the
+   contracts of an agency or of a vendor (as single winner or as member of a consortium), from
+   python and as a local HTTP API returning json. The queries share a pool of read connections,
+   and their results are kept in an LRU cache, emptied when an extract completes.
+   Usage:
+      avcp_query.py serve (to serve the HTTP API)
+   HTTP API:
+      GET /contracts/CIG
+      GET /agencies/AGENCY_CODE/contracts?page=N&page_size=N
+      GET /vendors/VENDOR_CODE/contracts?page=N&page_size=N (also an aggregate vendor code)
+      GET /stats (hits and misses of the cache)
+   Python API:
+      service = avcp_query.QueryService("avcp_contracts.db")
+      service.contract(cig)
+      service.agency_contracts(agency_code,page=1,page_size=100)
+      service.vendor_contracts(vendor_code,page=1,page_size=100)
+   Options:
+      --database=FILE (database to query, default avcp_contracts.db)
+      --host=HOST (address the HTTP API listens on, default 127.0.0.1)
+      --port=N (port of the HTTP API, default 8080)
+      --pool_size=N (maximum number of read connections, default 8)
+      --cache_size=N (results kept in the LRU cache, default 10000)
+'''
+
+
+import os
+import sys
+import getopt
+import json
+import sqlite3
+import threading
+import collections
+import urllib
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+database_name = "avcp_contracts.db"
+server_host = "127.0.0.1"
+server_port = 8080
+pool_size = 8
+cache_size = 10000
+default_page_size = 100
+#the cigs of a page are bound as parameters of a single query, so a page must stay below
+#the 999 parameters allowed by the older sqlite libraries
+max_page_size = 500
+
+CONTRACT_COLUMNS = ['cig','oggetto','sceltaContraente','importoAggiudicazione','importoSommeLiquidate',
+                    'pubblicationYear','pubblicationMonth','pubblication_date','agency_fiscal_code','agency_name']
+CONTRACTS_QUERY = 'SELECT contracts.cig, contracts.oggetto, procedure_types.sceltaContraente, contracts.importoAggiudicazione, contracts.importoSommeLiquidate, contracts.pubblicationYear, contracts.pubblicationMonth, contracts.pubblication_date, contracts.agency_fiscal_code, public_agencies.agency_name FROM contracts LEFT JOIN procedure_types ON contracts.procedure_id = procedure_types.procedure_id LEFT JOIN public_agencies ON contracts.agency_fiscal_code = public_agencies.agency_fiscal_code'
+CONTRACTS_ORDER = ' ORDER BY contracts.pubblicationYear, contracts.pubblicationMonth, contracts.cig LIMIT ? OFFSET ?'
+CONTRACT_QUERY = CONTRACTS_QUERY + ' WHERE contracts.cig = ?'
+AGENCY_CONTRACTS_QUERY = CONTRACTS_QUERY + ' WHERE contracts.agency_fiscal_code = ?' + CONTRACTS_ORDER
+#contracts won by a vendor alone, by a consortium it is a member of, or by an aggregate vendor
+VENDOR_CONTRACTS_QUERY = CONTRACTS_QUERY + ' WHERE contracts.cig IN (SELECT cig FROM winners WHERE vendor_code = :code UNION SELECT aggregate_winners.cig FROM aggregate_vendor_members JOIN aggregate_winners ON aggregate_winners.aggregate_vendor_code = aggregate_vendor_members.aggregate_vendor_code WHERE aggregate_vendor_members.vendor_code = :code UNION SELECT cig FROM aggregate_winners WHERE aggregate_vendor_code = :code) ORDER BY contracts.pubblicationYear, contracts.pubblicationMonth, contracts.cig LIMIT :limit OFFSET :offset'
+#winners of a list of contracts (%s is replaced by the placeholders of the cigs)
+WINNERS_QUERY = 'SELECT winners.cig, vendors.vendor_code, vendors.vendor_name, 0 FROM winners JOIN vendors ON winners.vendor_code = vendors.vendor_code WHERE winners.cig IN (%s) UNION ALL SELECT aggregate_winners.cig, aggregate_vendors.aggregate_vendor_code, aggregate_vendors.aggregate_vendor_name, 1 FROM aggregate_winners JOIN aggregate_vendors ON aggregate_winners.aggregate_vendor_code = aggregate_vendors.aggregate_vendor_code WHERE aggregate_winners.cig IN (%s)'
+MEMBERS_QUERY = 'SELECT aggregate_vendor_members.aggregate_vendor_code, vendors.vendor_code, vendors.vendor_name, aggregate_vendor_members.role FROM aggregate_vendor_members JOIN vendors ON aggregate_vendor_members.vendor_code = vendors.vendor_code WHERE aggregate_vendor_members.aggregate_vendor_code IN (%s) ORDER BY aggregate_vendor_members.id'
+
+class ConnectionPool(object):
+    '''Pool of at most size read-only connections to a database file, shared by the threads
+       of the service. identity is the (device,inode) of the file the connections refer to'''
+    def __init__(self,filename,size,identity):
+        self.filename = filename
+        self.size = size
+        self.identity = identity
+        self.idle = []
+        self.created = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        '''Get an idle connection, opening a new one if less than size are open, otherwise
+           waiting for a connection to be released. Returns None if the pool is closed, also
+           while waiting (the caller should then use the pool of the new database file)'''
+        with self.condition:
+            while True:
+                if( self.closed ):
+                    return None
+                if( len(self.idle) > 0 ):
+                    return self.idle.pop()
+                if( self.created < self.size ):
+                    self.created = self.created + 1
+                    break
+                self.condition.wait()
+        try:
+            connection = sqlite3.connect(self.filename,check_same_thread=False)
+            connection.execute("PRAGMA query_only=ON")
+        except sqlite3.Error:
+            with self.condition:
+                self.created = self.created - 1
+                self.condition.notify()
+            raise
+        return connection
+
+    def release(self,connection):
+        '''Give back a connection taken with acquire (it is closed if the pool was closed)'''
+        with self.condition:
+            if( not self.closed ):
+                self.idle.append(connection)
+                self.condition.notify()
+                return
+        connection.close()
+
+    def close(self):
+        '''Close the idle connections, and the others when they are released. The threads
+           waiting for a connection are woken up, and acquire returns None to them'''
+        with self.condition:
+            self.closed = True
+            idle = self.idle
+            self.idle = []
+            self.condition.notify_all()
+        for connection in idle:
+            connection.close()
+
+def file_identity(filename):
+    '''Get the (device,inode) of a file, or None if it does not exist'''
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return (stat.st_dev,stat.st_ino)
+
+def fetch_contracts(connection,query,parameters):
+    '''Run a query of CONTRACTS_QUERY and return its contracts as dicts, with their winners'''
+    contracts = [dict(zip(CONTRACT_COLUMNS,row)) for row in connection.execute(query,parameters)]
+    if( len(contracts) == 0 ):
+        return contracts
+    cigs = [contract['cig'] for contract in contracts]
+    placeholders = ", ".join(["?"]*len(cigs))
+    winners = collections.defaultdict(list)
+    aggregate_vendors = {}
+    for cig, code, name, aggregate in connection.execute(WINNERS_QUERY % (placeholders,placeholders),cigs+cigs):
+        winner = dict(vendor_code=code,vendor_name=name)
+        if( aggregate ):
+            winner['members'] = []
+            aggregate_vendors.setdefault(code,[]).append(winner)
+        winners[cig].append(winner)
+    if( len(aggregate_vendors) > 0 ):
+        codes = list(aggregate_vendors.keys())
+        for aggregate_vendor_code, code, name, role in connection.execute(MEMBERS_QUERY % ", ".join(["?"]*len(codes)),codes):
+            for winner in aggregate_vendors[aggregate_vendor_code]:
+                winner['members'].append(dict(vendor_code=code,vendor_name=name,role=role))
+    for contract in contracts:
+        contract['winners'] = winners[contract['cig']]
+    return contracts
+
+def contracts_page(contracts,page,page_size):
+    '''Build a page of results from the contracts fetched for it (one more than page_size, to
+       know if there is a next page)'''
+    next_page = None
+    if( len(contracts) > page_size ):
+        next_page = page + 1
+    return dict(contracts=contracts[:page_size],page=page,page_size=page_size,next_page=next_page)
+
+def check_page(page,page_size):
+    '''Raise ValueError if page or page_size are not valid'''
+    if( page < 1 ):
+        raise ValueError("page must be at least 1")
+    if( page_size < 1 or page_size > max_page_size ):
+        raise ValueError("page_size must be between 1 and " + str(max_page_size))
+
+class QueryService(object):
+    '''Answer the lookups of contracts by CIG, agency and vendor on a database built by extract.
+       The results are kept in an LRU cache of cache_size entries, and must not be modified.
+       The cache is emptied when an extract completes: an incremental extract increments the
+       user_version of the database, and a full extract replaces the database file (which is
+       used only once its extract is complete, until then the connections to the previous file
+       are used)'''
+    def __init__(self,filename=database_name,pool_size=pool_size,cache_size=cache_size):
+        if( not os.path.exists(filename) ):
+            raise IOError("The database " + filename + " does not exist, run the extract first")
+        self.filename = filename
+        self.pool_size = pool_size
+        self.cache_size = cache_size
+        self.pool = ConnectionPool(filename,pool_size,file_identity(filename))
+        self.cache = collections.OrderedDict()
+        self.generation = None
+        self.statistics = dict(hits=0,misses=0,invalidations=0)
+        self.lock = threading.Lock()
+
+    def current_pool(self):
+        '''Get the pool of connections to the current database file, switching to a new file
+           (and emptying the cache) if its extract is complete'''
+        pool = self.pool
+        identity = file_identity(self.filename)
+        if( identity is None or identity == pool.identity ):
+            return pool
+        new_pool = ConnectionPool(self.filename,self.pool_size,identity)
+        try:
+            #a new pool is not closed, so acquire returns a connection
+            connection = new_pool.acquire()
+            try:
+                complete = connection.execute("PRAGMA user_version").fetchone()[0] > 0
+            finally:
+                new_pool.release(connection)
+        except sqlite3.Error:
+            #the new file is still being written
+            complete = False
+        with self.lock:
+            if( not complete or self.pool is not pool ):
+                new_pool.close()
+                return self.pool
+            self.pool = new_pool
+            self.cache.clear()
+            self.generation = None
+            self.statistics['invalidations'] = self.statistics['invalidations'] + 1
+        pool.close()
+        return new_pool
+
+    def cached_query(self,key,compute):
+        '''Get the result of compute(connection) for the key from the cache, or compute it
+           with a pooled connection and add it to the cache'''
+        while True:
+            pool = self.current_pool()
+            connection = pool.acquire()
+            #None if the pool was closed while waiting, as the database file was replaced
+            if( connection is not None ):
+                break
+        try:
+            generation = connection.execute("PRAGMA user_version").fetchone()[0]
+            with self.lock:
+                current = pool is self.pool
+                if( current and generation != self.generation ):
+                    if( self.generation is not None ):
+                        self.statistics['invalidations'] = self.statistics['invalidations'] + 1
+                    self.cache.clear()
+                    self.generation = generation
+                if( current and key in self.cache ):
+                    #moved to the end, as the most recently used
+                    result = self.cache.pop(key)
+                    self.cache[key] = result
+                    self.statistics['hits'] = self.statistics['hits'] + 1
+                    return result
+                self.statistics['misses'] = self.statistics['misses'] + 1
+            result = compute(connection)
+        finally:
+            pool.release(connection)
+        with self.lock:
+            if( pool is self.pool and generation == self.generation ):
+                self.cache[key] = result
+                if( len(self.cache) > self.cache_size ):
+                    self.cache.popitem(last=False)
+        return result
+
+    def contract(self,cig):
+        '''Get a contract (a dict of CONTRACT_COLUMNS and its winners), or None if there is no
+           contract with this cig'''
+        def compute(connection):
+            contracts = fetch_contracts(connection,CONTRACT_QUERY,(cig,))
+            if( len(contracts) == 0 ):
+                return None
+            return contracts[0]
+        return self.cached_query(('contract',cig),compute)
+
+    def agency_contracts(self,agency_code,page=1,page_size=default_page_size):
+        '''Get a page of the contracts of an agency, ordered by publication month and cig'''
+        check_page(page,page_size)
+        def compute(connection):
+            contracts = fetch_contracts(connection,AGENCY_CONTRACTS_QUERY,(agency_code,page_size+1,(page-1)*page_size))
+            return contracts_page(contracts,page,page_size)
+        return self.cached_query(('agency',agency_code,page,page_size),compute)
+
+    def vendor_contracts(self,vendor_code,page=1,page_size=default_page_size):
+        '''Get a page of the contracts won by a vendor, alone or as a member of a consortium
+           (or by an aggregate vendor), ordered by publication month and cig'''
+        check_page(page,page_size)
+        def compute(connection):
+            parameters = dict(code=vendor_code,limit=page_size+1,offset=(page-1)*page_size)
+            contracts = fetch_contracts(connection,VENDOR_CONTRACTS_QUERY,parameters)
+            return contracts_page(contracts,page,page_size)
+        return self.cached_query(('vendor',vendor_code,page,page_size),compute)
+
+    def cache_statistics(self):
+        '''Get the hits, misses and invalidations of the cache, and its size'''
+        with self.lock:
+            statistics = dict(self.statistics)
+            statistics['size'] = len(self.cache)
+        return statistics
+
+    def close(self):
+        '''Close the connections of the service'''
+        self.pool.close()
+
+class QueryRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Answer the requests of the HTTP API (see the usage) with the QueryService of the server'''
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        parameters = urlparse.parse_qs(url.query)
+        service = self.server.service
+        try:
+            #invalid utf-8 raises a UnicodeDecodeError, a ValueError
+            path = [urllib.unquote(part).decode('utf-8') for part in url.path.strip('/').split('/')]
+            page = int(parameters.get('page',['1'])[0])
+            page_size = int(parameters.get('page_size',[str(default_page_size)])[0])
+            if( len(path) == 2 and path[0] == 'contracts' ):
+                result = service.contract(path[1])
+            elif( len(path) == 3 and path[0] == 'agencies' and path[2] == 'contracts' ):
+                result = service.agency_contracts(path[1],page,page_size)
+            elif( len(path) == 3 and path[0] == 'vendors' and path[2] == 'contracts' ):
+                result = service.vendor_contracts(path[1],page,page_size)
+            elif( path == ['stats'] ):
+                result = service.cache_statistics()
+            else:
+                self.send_json(404,dict(error="Unknown path " + url.path))
+                return
+        except ValueError as e:
+            self.send_json(400,dict(error=str(e)))
+            return
+        if( result is None ):
+            self.send_json(404,dict(error="No contract with cig " + path[1]))
+            return
+        self.send_json(200,result)
+
+    def send_json(self,status,result):
+        body = json.dumps(result)
+        self.send_response(status)
+        self.send_header("Content-Type","application/json")
+        self.send_header("Content-Length",str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self,format,*args):
+        return
+
+class QueryServer(SocketServer.ThreadingMixIn,BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+def serve():
+    '''Serve the HTTP API on server_host:server_port until interrupted'''
+    service = QueryService(database_name,pool_size,cache_size)
+    server = QueryServer((server_host,server_port),QueryRequestHandler)
+    server.service = service
+    print("Serving " + database_name + " on http://" + server_host + ":" + str(server.server_address[1]) + "/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+def main():
+    '''Main method of the query service'''
+    global database_name
+    global server_host
+    global server_port
+    global pool_size
+    global cache_size
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "h", ["help","database=","host=","port=","pool_size=","cache_size="])
+    except getopt.error:
+        print("for help use --help")
+        sys.exit(2)
+
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            print(__doc__)
+            sys.exit(0)
+        if o == "--database":
+            database_name = a
+        if o == "--host":
+            server_host = a
+        if o == "--port":
+            server_port = int(a)
+        if o == "--pool_size":
+            pool_size = int(a)
+        if o == "--cache_size":
+            cache_size = int(a)
+
+    for arg in args:
+        if( arg == "serve" ):
+            serve()
+
+if __name__ == "__main__":
+    main()
@@ -7,10 +7,37 @@
       portaletrasparenza-avcp-scraper.py download (to download the data of closed tenders)
       portaletrasparenza-avcp-scraper.py download_open (to dowload the data of open tenders)
       portaletrasparenza-avcp-scraper.py indent (to indent in a clean way the data)
-      portaletrasparenza-avcp-scraper.py push (to push the data on github)
+      portaletrasparenza-avcp-scraper.py push (to commit and push on github the data files changed since the last push)
+      portaletrasparenza-avcp-scraper.py extract (to extract the data in the avcp_contracts.db sqlite database)
+      portaletrasparenza-avcp-scraper.py export (to export the extracted data as csv and parquet files in dumps/)
+      portaletrasparenza-avcp-scraper.py search (to search the extracted contracts by words of their subject, agency or winner)
+      portaletrasparenza-avcp-scraper.py aggregate (to update the tables of spend by agency, winner and procedure in each month)
+      portaletrasparenza-avcp-scraper.py reconcile (to map the name variants of agencies and vendors to a canonical name in the reconciled_names table)
    You can also combine the operation, so that they can be executed in series, for example:
       portaletrasparenza-avcp-scraper.py download indent push
    Downloads the data, indent it and it pushes it on a github 
+   When download and extract are combined, the months are extracted while they are downloaded
+   Options:
+      --download_workers=N (number of months downloaded concurrently, default 8)
+      --force_download (download again all the months, ignoring the download manifest)
+      --recent_months=N (closed tenders of the last N months are always checked for changes, default 3)
+      --extract_processes=N (number of processes parsing the xml files during extract, default 1)
+      --incremental (extract loads only the months changed since the last extract in the existing database)
+      --no_pipeline (run download and extract one after the other, instead of as a pipeline)
+      --export_formats=csv,parquet (formats written by export, default csv,parquet)
+      --report=FILE (write a json report of the run: time, size and speed of each month download,
+                     parse and write, rows inserted in each table, entity index hit rates, warnings
+                     and peak memory of each stage)
+      --progress (keep a progress line updated on stderr)
+      --compress=gzip|zstd (keep the monthly xml files compressed, as .xml.gz or .xml.zst)
+      --result_cap=N (maximum number of lots returned by the portal, the months with more lots are
+                      downloaded in pieces split by search key, by default only the exports that are
+                      not complete xml documents are split)
+      --fts (extract also builds a full text index of the contract subjects and of the names)
+      --query=TEXT (words searched by search in the contract subjects and agency and winner names)
+      --limit=N (maximum number of contracts printed by search, default 20)
+      --buffer_size=N (rows of each table buffered by extract before inserting them, default 10000)
+      --git_email=EMAIL (author email of the commits of push, default the one of the git configuration)
 '''
 
 
@@ -41,19 +68,105 @@ import sys
 import requests
 import getopt
 import subprocess
-import xml.dom.minidom
-import codecs
+import threading
+import time
+import Queue
+import hashlib
+import json
+import collections
+import multiprocessing
+import sqlite3
+import xml.sax
+import xml.sax.handler
+import xml.sax.saxutils
+import filecmp
 import datetime
-import xml.etree.ElementTree
+import resource
+import zlib
+import re
+import unicodedata
+import array
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
 import dataset
 import sqlalchemy
+import csv
+import shutil
+#pyarrow is needed only for the parquet export
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+#zstandard is needed only for the zstd compressed storage
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 #Year to scrape
 years_to_download = range(2011,2016)
 months_in_a_year = range(1,13)
 
+#Portal export endpoint (see the web interface documentation above)
+avcp_export_url = "http://portaletrasparenza.avcp.it/Microstrategy/asp/export_xml.aspx"
+
+#Download settings: the months are downloaded concurrently by a bounded pool of
+#threads sharing a single keep-alive HTTP session
+download_workers = 8
+download_chunk_size = 1024*1024
+download_timeout = 300
+download_max_retries = 5
+download_retry_backoff = 2.0
+http_session = None
+
+#The portal truncates the responses with too many lots (see the web interface documentation
+#above). A response that is not a complete xml document, or that has at least portal_result_cap
+#lots (if the cap is known), is considered truncated, and the month is downloaded again split
+#by search key: the search key is assumed to match the beginning of the fiscal code or name,
+#so a truncated key is split in the keys extended by each character of SEARCH_KEY_ALPHABET,
+#up to max_search_key_length characters and at most max_piece_requests requests for a month
+#(see download_export). A split month is complete only if this assumption holds, and it is not
+#verified: the lots whose codes and names start with a character outside SEARCH_KEY_ALPHABET
+#(or that the search key matches in another way) are in no piece and are silently dropped.
+#The download fails if the merged pieces have less lots than the truncated response, but that
+#catches only some of the lost lots, as a truncated response has only a part of the lots
+portal_result_cap = None
+SEARCH_KEY_ALPHABET = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+max_search_key_length = 16
+max_piece_requests = 2000
+LOTTO_START_TAG = b"<lotto>"
+LOTTO_END_TAG = b"</lotto>"
+CIG_PATTERN = re.compile(br"<cig>\s*([^<]*?)\s*</cig>")
+ROOT_ELEMENT_PATTERN = re.compile(br"<([A-Za-z_][-.:\w]*)")
+
+#Download manifest: for each downloaded file it records size, content hash, HTTP
+#validators (ETag/Last-Modified), number of lots and fetch time, so that a refresh downloads
+#only the months that are new, recent or changed, and the content hash and number of lots
+#last published by push, so that push publishes only the files that changed
+manifest_filename = "avcp_download_manifest.json"
+#author email of the commits of push (None for the one of the git configuration)
+git_email = None
+#closed tenders of months older than this are considered stable and not downloaded again
+recent_months_to_refresh = 3
+force_download = False
+
+#Storage of the monthly xml files: None for plain xml, 'gzip' or 'zstd' to keep each month
+#compressed in its own file (see open_xml_file), compressed while it is downloaded and
+#decompressed as a stream when it is read
+compression = None
+COMPRESSED_EXTENSIONS = {'gzip':'.gz','zstd':'.zst'}
+gzip_compression_level = 6
+zstd_compression_level = 3
+
 database_name = "avcp_contracts.db"
 database_url = "sqlite:///" + database_name
+#A full extract builds the database in this file, which replaces database_name only when the
+#extract is complete, so a failed extract (for example a failed download of the pipeline)
+#leaves the previous database as it was
+bulk_load_database_name = database_name + ".part"
 
 PUBLIC_AGENCIES = 'public_agencies'
 VENDORS = 'vendors'
@@ -61,189 +174,1159 @@ AGGREGATE_VENDORS = 'aggregate_vendors'
 CONTRACTS = 'contracts'
 WINNERS = 'winners'
 AGGREGATE_WINNERS = 'aggregate_winners'
+AGGREGATE_VENDOR_MEMBERS = 'aggregate_vendor_members'
 PUBLIC_AGENCIES_ALTERNATIVE_NAMES = 'public_agencies_alternative_names'
 VENDORS_ALTERNATIVE_NAMES = 'vendors_alternative_names'
+SOURCE_FILES = 'source_files'
+PROCEDURE_TYPES = 'procedure_types'
 CIG_CODE_NAME = 'cig'
 VENDOR_CODE = 'vendor_code'
 AGENCY_CODE = 'agency_fiscal_code'
 AGGREGATE_VENDOR_CODE = 'aggregate_vendor_code'
 
-#Database buffer
+#Schema of the tables created by extract_data
+DATABASE_SCHEMA = [
+    (PUBLIC_AGENCIES, [(AGENCY_CODE,'TEXT PRIMARY KEY'),('agency_name','TEXT')]),
+    (VENDORS, [(VENDOR_CODE,'TEXT PRIMARY KEY'),('vendor_name','TEXT'),('vendor_country','TEXT')]),
+    (AGGREGATE_VENDORS, [(AGGREGATE_VENDOR_CODE,'TEXT PRIMARY KEY'),('aggregate_vendor_name','TEXT')]),
+    #members of each aggregate vendor, with their role in the first consortium seen
+    (AGGREGATE_VENDOR_MEMBERS, [('id','INTEGER PRIMARY KEY'),(AGGREGATE_VENDOR_CODE,'TEXT'),(VENDOR_CODE,'TEXT'),('role','TEXT')]),
+    #the sceltaContraente of the contracts is stored once in PROCEDURE_TYPES, and referenced by procedure_id
+    (PROCEDURE_TYPES, [('procedure_id','INTEGER PRIMARY KEY'),('sceltaContraente','TEXT')]),
+    (CONTRACTS, [(CIG_CODE_NAME,'TEXT PRIMARY KEY'),('oggetto','TEXT'),('procedure_id','INTEGER'),
+                 ('importoAggiudicazione','TEXT'),('importoSommeLiquidate','TEXT'),(AGENCY_CODE,'TEXT'),
+                 ('pubblicationMonth','INTEGER'),('pubblicationYear','INTEGER'),('pubblication_date','TEXT')]),
+    (WINNERS, [(CIG_CODE_NAME,'TEXT PRIMARY KEY'),(VENDOR_CODE,'TEXT')]),
+    (AGGREGATE_WINNERS, [(CIG_CODE_NAME,'TEXT PRIMARY KEY'),(AGGREGATE_VENDOR_CODE,'TEXT')]),
+    (PUBLIC_AGENCIES_ALTERNATIVE_NAMES, [('id','INTEGER PRIMARY KEY'),(AGENCY_CODE,'TEXT'),('alternative_agency_name','TEXT')]),
+    (VENDORS_ALTERNATIVE_NAMES, [('id','INTEGER PRIMARY KEY'),(VENDOR_CODE,'TEXT'),('alternative_vendor_name','TEXT')]),
+    #monthly files loaded in the database, used by the incremental extract
+    (SOURCE_FILES, [('filename','TEXT PRIMARY KEY'),('pubblicationYear','INTEGER'),('pubblicationMonth','INTEGER'),
+                    ('sha1','TEXT'),('lots','INTEGER'),('loaded_at','TEXT')]),
+]
+
+#Secondary indexes, built by extract_data after all the rows are loaded
+#(the cig, vendor_code, agency_fiscal_code and aggregate_vendor_code primary keys are already indexed).
+#The indexes of the winners include the cig, so that search finds the contracts won by a vendor
+#from the index alone
+DATABASE_INDEXES = [
+    (CONTRACTS, [AGENCY_CODE]),
+    (CONTRACTS, ['pubblicationYear','pubblicationMonth']),
+    (WINNERS, [VENDOR_CODE,CIG_CODE_NAME]),
+    (AGGREGATE_WINNERS, [AGGREGATE_VENDOR_CODE,CIG_CODE_NAME]),
+    (AGGREGATE_VENDOR_MEMBERS, [VENDOR_CODE]),
+    (AGGREGATE_VENDOR_MEMBERS, [AGGREGATE_VENDOR_CODE]),
+    (PUBLIC_AGENCIES_ALTERNATIVE_NAMES, [AGENCY_CODE]),
+    (VENDORS_ALTERNATIVE_NAMES, [VENDOR_CODE]),
+]
+
+#Winners of each contract, single vendors and consortia (materialized by dump_all_winners)
+ALL_WINNERS_QUERY = 'SELECT winners.cig AS cig, vendors.vendor_code AS vendor_code, vendors.vendor_name AS vendor_name FROM winners JOIN vendors ON winners.vendor_code = vendors.vendor_code UNION SELECT aggregate_winners.cig AS cig, aggregate_vendors.aggregate_vendor_code AS vendor_code, aggregate_vendors.aggregate_vendor_name AS vendor_name FROM aggregate_winners JOIN aggregate_vendors ON aggregate_winners.aggregate_vendor_code = aggregate_vendors.aggregate_vendor_code'
+
+#Export of the contracts with their agency and winners (the same data of the
+#openspending_freeze.yaml datafreeze dump), as csv and as parquet files
+#partitioned by pubblicationYear/pubblicationMonth
+export_directory = "dumps"
+export_basename = "avcp_contracts"
+export_formats = ['csv','parquet']
+export_chunk_size = 50000
+EXPORT_COLUMNS = ['cig','pubblication_date','oggetto','importoAggiudicazione','agency_fiscal_code','agency_name',
+                  'vendor_code','vendor_name','sceltaContraente','importoSommeLiquidate']
+EXPORT_AMOUNT_COLUMNS = ['importoAggiudicazione','importoSommeLiquidate']
+EXPORT_QUERY = 'SELECT contracts.cig, contracts.pubblication_date, contracts.oggetto, contracts.importoAggiudicazione, public_agencies.agency_fiscal_code, public_agencies.agency_name, all_winners.vendor_code, all_winners.vendor_name, procedure_types.sceltaContraente, contracts.importoSommeLiquidate, contracts.pubblicationYear, contracts.pubblicationMonth FROM contracts LEFT JOIN public_agencies ON contracts.agency_fiscal_code = public_agencies.agency_fiscal_code LEFT JOIN procedure_types ON contracts.procedure_id = procedure_types.procedure_id LEFT JOIN (' + ALL_WINNERS_QUERY + ') AS all_winners ON contracts.cig = all_winners.cig ORDER BY contracts.pubblicationYear, contracts.pubblicationMonth'
+
+#Full text index of the contract subjects and of all the canonical and alternative names of
+#agencies, vendors and aggregate vendors, built by extract with --fts and used by search.
+#contracts_fts indexes the oggetto of contracts (external content, kept updated by triggers),
+#entity_names_fts the names with the kind and code of the entity they refer to
+CONTRACTS_FTS = 'contracts_fts'
+ENTITY_NAMES_FTS = 'entity_names_fts'
+full_text_index = False
+FULL_TEXT_INDEX_SCHEMA = [
+    'CREATE VIRTUAL TABLE IF NOT EXISTS ' + CONTRACTS_FTS + ' USING fts5(oggetto, content=' + CONTRACTS + ', content_rowid=rowid)',
+    'CREATE VIRTUAL TABLE IF NOT EXISTS ' + ENTITY_NAMES_FTS + ' USING fts5(name, kind UNINDEXED, code UNINDEXED)',
+    'CREATE TRIGGER IF NOT EXISTS ' + CONTRACTS_FTS + '_insert AFTER INSERT ON ' + CONTRACTS + ' BEGIN INSERT INTO ' + CONTRACTS_FTS + ' (rowid, oggetto) VALUES (new.rowid, new.oggetto); END',
+    'CREATE TRIGGER IF NOT EXISTS ' + CONTRACTS_FTS + '_delete AFTER DELETE ON ' + CONTRACTS + ' BEGIN INSERT INTO ' + CONTRACTS_FTS + ' (' + CONTRACTS_FTS + ', rowid, oggetto) VALUES (\'delete\', old.rowid, old.oggetto); END',
+    'CREATE TRIGGER IF NOT EXISTS ' + CONTRACTS_FTS + '_update AFTER UPDATE ON ' + CONTRACTS + ' BEGIN INSERT INTO ' + CONTRACTS_FTS + ' (' + CONTRACTS_FTS + ', rowid, oggetto) VALUES (\'delete\', old.rowid, old.oggetto); INSERT INTO ' + CONTRACTS_FTS + ' (rowid, oggetto) VALUES (new.rowid, new.oggetto); END',
+]
+ENTITY_NAMES_QUERY = 'SELECT agency_name, \'agency\', ' + AGENCY_CODE + ' FROM ' + PUBLIC_AGENCIES + ' UNION ALL SELECT alternative_agency_name, \'agency\', ' + AGENCY_CODE + ' FROM ' + PUBLIC_AGENCIES_ALTERNATIVE_NAMES + ' UNION ALL SELECT vendor_name, \'vendor\', ' + VENDOR_CODE + ' FROM ' + VENDORS + ' UNION ALL SELECT alternative_vendor_name, \'vendor\', ' + VENDOR_CODE + ' FROM ' + VENDORS_ALTERNATIVE_NAMES + ' UNION ALL SELECT aggregate_vendor_name, \'aggregate_vendor\', ' + AGGREGATE_VENDOR_CODE + ' FROM ' + AGGREGATE_VENDORS
+#A full text query is matched word by word, as the words can be found in different documents (for
+#example a word in the oggetto and one in the name of the agency). The agencies, vendors and aggregate
+#vendors with a name matching a word (the :word parameter) are the word_names of the word, with the
+#best bm25 score of their names (the rank of the FTS5 tables, lower is better). Each query has a part
+#for the subjects, enough for a word matching no names, and one for the names
+FULL_TEXT_WORD_NAMES_QUERY = 'SELECT kind, code, min(rank) AS score FROM ' + ENTITY_NAMES_FTS + ' WHERE ' + ENTITY_NAMES_FTS + ' MATCH :word GROUP BY kind, code'
+#The words are compared by the number of subjects and names matching them (each counted up to :cap),
+#that is cheaper to count than the contracts of the matching names, counted (up to :cap, without
+#limit if negative) from the indexes without looking up the contracts
+FULL_TEXT_WORD_DOCUMENTS_QUERY = 'SELECT (SELECT count(*) FROM (SELECT 1 FROM ' + CONTRACTS_FTS + ' WHERE ' + CONTRACTS_FTS + ' MATCH :word LIMIT :cap)), (SELECT count(*) FROM (SELECT 1 FROM ' + ENTITY_NAMES_FTS + ' WHERE ' + ENTITY_NAMES_FTS + ' MATCH :word LIMIT :cap))'
+FULL_TEXT_WORD_COUNT_QUERY = 'WITH word_names AS (SELECT DISTINCT kind, code FROM ' + ENTITY_NAMES_FTS + ' WHERE ' + ENTITY_NAMES_FTS + ' MATCH :word) SELECT count(*) FROM (SELECT 1 FROM ' + CONTRACTS_FTS + ' WHERE ' + CONTRACTS_FTS + ' MATCH :word UNION ALL SELECT 1 FROM word_names JOIN contracts ON word_names.kind = \'agency\' AND contracts.agency_fiscal_code = word_names.code UNION ALL SELECT 1 FROM word_names JOIN winners ON word_names.kind = \'vendor\' AND winners.vendor_code = word_names.code UNION ALL SELECT 1 FROM word_names JOIN aggregate_winners ON word_names.kind = \'aggregate_vendor\' AND aggregate_winners.aggregate_vendor_code = word_names.code LIMIT :cap)'
+#The contracts matching a word in their oggetto or in the names of their agency or winners, by rowid
+#with the best score of the word, to take the candidate contracts from the most selective word
+FULL_TEXT_SUBJECT_CONTRACTS_QUERY = 'SELECT rowid AS id, rank AS score FROM ' + CONTRACTS_FTS + ' WHERE ' + CONTRACTS_FTS + ' MATCH :word'
+FULL_TEXT_WORD_CONTRACTS_QUERY = 'SELECT id, min(score) AS score FROM (' + FULL_TEXT_SUBJECT_CONTRACTS_QUERY + ' UNION ALL SELECT contracts.rowid, word_names.score FROM word_names JOIN contracts ON word_names.kind = \'agency\' AND contracts.agency_fiscal_code = word_names.code UNION ALL SELECT contracts.rowid, word_names.score FROM word_names JOIN winners ON word_names.kind = \'vendor\' AND winners.vendor_code = word_names.code JOIN contracts ON contracts.cig = winners.cig UNION ALL SELECT contracts.rowid, word_names.score FROM word_names JOIN aggregate_winners ON word_names.kind = \'aggregate_vendor\' AND aggregate_winners.aggregate_vendor_code = word_names.code JOIN contracts ON contracts.cig = aggregate_winners.cig) GROUP BY id'
+#Conditions on a candidate contract for the other words: looking up the candidate in the indexes
+#(for few candidates), or in the lists of all the contracts matching the word (for many candidates)
+FULL_TEXT_SUBJECT_LOOKUP_CONDITION = 'EXISTS (SELECT 1 FROM ' + CONTRACTS_FTS + ' WHERE ' + CONTRACTS_FTS + ' MATCH :word AND ' + CONTRACTS_FTS + '.rowid = contracts.rowid)'
+FULL_TEXT_LOOKUP_CONDITION = FULL_TEXT_SUBJECT_LOOKUP_CONDITION + ' OR contracts.agency_fiscal_code IN (SELECT code FROM word_names WHERE kind = \'agency\') OR EXISTS (SELECT 1 FROM winners WHERE winners.cig = contracts.cig AND winners.vendor_code IN (SELECT code FROM word_names WHERE kind = \'vendor\')) OR EXISTS (SELECT 1 FROM aggregate_winners WHERE aggregate_winners.cig = contracts.cig AND aggregate_winners.aggregate_vendor_code IN (SELECT code FROM word_names WHERE kind = \'aggregate_vendor\'))'
+FULL_TEXT_SUBJECT_LIST_CONDITION = 'contracts.rowid IN (SELECT rowid FROM ' + CONTRACTS_FTS + ' WHERE ' + CONTRACTS_FTS + ' MATCH :word)'
+FULL_TEXT_LIST_CONDITION = FULL_TEXT_SUBJECT_LIST_CONDITION + ' OR contracts.agency_fiscal_code IN (SELECT code FROM word_names WHERE kind = \'agency\') OR contracts.cig IN (SELECT winners.cig FROM word_names JOIN winners ON word_names.kind = \'vendor\' AND winners.vendor_code = word_names.code) OR contracts.cig IN (SELECT aggregate_winners.cig FROM word_names JOIN aggregate_winners ON word_names.kind = \'aggregate_vendor\' AND aggregate_winners.aggregate_vendor_code = word_names.code)'
+#The best score of a word for each of the contracts matching all the words (the matches table)
+FULL_TEXT_SUBJECT_SCORES_QUERY = 'SELECT rowid AS id, rank AS score FROM ' + CONTRACTS_FTS + ' WHERE ' + CONTRACTS_FTS + ' MATCH :word AND +rowid IN (SELECT id FROM matches)'
+FULL_TEXT_WORD_SCORES_QUERY = 'SELECT id, min(score) AS score FROM (' + FULL_TEXT_SUBJECT_SCORES_QUERY + ' UNION ALL SELECT matches.id, word_names.score FROM matches JOIN word_names ON word_names.kind = \'agency\' AND word_names.code = matches.agency_code UNION ALL SELECT matches.id, word_names.score FROM matches JOIN winners ON winners.cig = matches.cig JOIN word_names ON word_names.kind = \'vendor\' AND word_names.code = winners.vendor_code UNION ALL SELECT matches.id, word_names.score FROM matches JOIN aggregate_winners ON aggregate_winners.cig = matches.cig JOIN word_names ON word_names.kind = \'aggregate_vendor\' AND word_names.code = aggregate_winners.aggregate_vendor_code) GROUP BY id'
+#The search query is built by full_text_search: the candidates of the most selective word, the
+#matches among them of all the other words, ranked by the sum of the scores of the words, and
+#finally the best ranked contracts with their agency and winner
+FULL_TEXT_MATCHES_QUERY = 'SELECT contracts.rowid AS id, contracts.cig AS cig, contracts.agency_fiscal_code AS agency_code FROM candidates CROSS JOIN contracts ON contracts.rowid = candidates.id'
+FULL_TEXT_RESULTS_QUERY = 'SELECT contracts.cig, ranked_contracts.score, contracts.pubblication_date, contracts.oggetto, contracts.importoAggiudicazione, public_agencies.agency_fiscal_code, public_agencies.agency_name, coalesce(vendors.vendor_code, aggregate_vendors.aggregate_vendor_code), coalesce(vendors.vendor_name, aggregate_vendors.aggregate_vendor_name) FROM ranked_contracts JOIN contracts ON contracts.rowid = ranked_contracts.id LEFT JOIN public_agencies ON contracts.agency_fiscal_code = public_agencies.agency_fiscal_code LEFT JOIN winners ON winners.cig = contracts.cig LEFT JOIN vendors ON vendors.vendor_code = winners.vendor_code LEFT JOIN aggregate_winners ON aggregate_winners.cig = contracts.cig LEFT JOIN aggregate_vendors ON aggregate_vendors.aggregate_vendor_code = aggregate_winners.aggregate_vendor_code ORDER BY ranked_contracts.score'
+#full_text_search takes the candidates from a word matching less than full_text_selective_documents
+#subjects and names, or else from the word matching less contracts, and looks up the other words
+#for each candidate if there are less than full_text_lookup_candidates candidates
+full_text_selective_documents = 1000
+full_text_lookup_candidates = 1000
+SEARCH_COLUMNS = ['cig','score','pubblication_date','oggetto','importoAggiudicazione','agency_fiscal_code','agency_name','vendor_code','vendor_name']
+search_text = None
+search_limit = 20
+
+#Aggregate tables built by aggregate_data after extract: the amounts of each contract parsed
+#once as numbers, and the number of contracts and the total amounts for each agency, winner
+#(vendor or aggregate vendor) and sceltaContraente in each month. Only the months changed
+#since the last aggregation (according to the sha1 of their file in source_files) are aggregated again
+CONTRACT_AMOUNTS = 'contract_amounts'
+SPEND_BY_AGENCY_MONTH = 'spend_by_agency_month'
+SPEND_BY_VENDOR_MONTH = 'spend_by_vendor_month'
+SPEND_BY_PROCEDURE_MONTH = 'spend_by_procedure_month'
+AGGREGATED_MONTHS = 'aggregated_months'
+AGGREGATE_TABLES = [CONTRACT_AMOUNTS, SPEND_BY_AGENCY_MONTH, SPEND_BY_VENDOR_MONTH, SPEND_BY_PROCEDURE_MONTH]
+#Months where contracts now published in another month were aggregated
+MOVED_CONTRACTS_MONTHS_QUERY = 'SELECT DISTINCT ' + CONTRACT_AMOUNTS + '.pubblicationYear, ' + CONTRACT_AMOUNTS + '.pubblicationMonth FROM ' + CONTRACT_AMOUNTS + ' JOIN ' + CONTRACTS + ' ON ' + CONTRACTS + '.cig = ' + CONTRACT_AMOUNTS + '.cig WHERE ' + CONTRACTS + '.pubblicationYear != ' + CONTRACT_AMOUNTS + '.pubblicationYear OR ' + CONTRACTS + '.pubblicationMonth != ' + CONTRACT_AMOUNTS + '.pubblicationMonth'
+AGGREGATES_SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS ' + CONTRACT_AMOUNTS + ' (cig TEXT PRIMARY KEY, agency_fiscal_code TEXT, sceltaContraente TEXT, pubblicationYear INTEGER, pubblicationMonth INTEGER, importoAggiudicazione REAL, importoSommeLiquidate REAL)',
+    'CREATE INDEX IF NOT EXISTS ' + CONTRACT_AMOUNTS + '_month_index ON ' + CONTRACT_AMOUNTS + ' (pubblicationYear, pubblicationMonth)',
+    'CREATE TABLE IF NOT EXISTS ' + SPEND_BY_AGENCY_MONTH + ' (pubblicationYear INTEGER, pubblicationMonth INTEGER, agency_fiscal_code TEXT, contracts INTEGER, importoAggiudicazione REAL, importoSommeLiquidate REAL, PRIMARY KEY (pubblicationYear, pubblicationMonth, agency_fiscal_code))',
+    'CREATE INDEX IF NOT EXISTS ' + SPEND_BY_AGENCY_MONTH + '_agency_index ON ' + SPEND_BY_AGENCY_MONTH + ' (agency_fiscal_code)',
+    'CREATE TABLE IF NOT EXISTS ' + SPEND_BY_VENDOR_MONTH + ' (pubblicationYear INTEGER, pubblicationMonth INTEGER, vendor_code TEXT, winner_type TEXT, contracts INTEGER, importoAggiudicazione REAL, importoSommeLiquidate REAL, PRIMARY KEY (pubblicationYear, pubblicationMonth, vendor_code, winner_type))',
+    'CREATE INDEX IF NOT EXISTS ' + SPEND_BY_VENDOR_MONTH + '_vendor_index ON ' + SPEND_BY_VENDOR_MONTH + ' (vendor_code)',
+    'CREATE TABLE IF NOT EXISTS ' + SPEND_BY_PROCEDURE_MONTH + ' (pubblicationYear INTEGER, pubblicationMonth INTEGER, sceltaContraente TEXT, contracts INTEGER, importoAggiudicazione REAL, importoSommeLiquidate REAL, PRIMARY KEY (pubblicationYear, pubblicationMonth, sceltaContraente))',
+    'CREATE TABLE IF NOT EXISTS ' + AGGREGATED_MONTHS + ' (pubblicationYear INTEGER, pubblicationMonth INTEGER, sha1 TEXT, aggregated_at TEXT, PRIMARY KEY (pubblicationYear, pubblicationMonth))',
+]
+#Statements aggregating a month (:year, :month), in order. The contracts of the month can be
+#aggregated in another month, if they were published again in this month (see insert_rows)
+AGGREGATE_MONTH_STATEMENTS = [
+    'DELETE FROM ' + CONTRACT_AMOUNTS + ' WHERE cig IN (SELECT cig FROM ' + CONTRACTS + ' WHERE pubblicationYear = :year AND pubblicationMonth = :month)',
+    'INSERT INTO ' + CONTRACT_AMOUNTS + ' SELECT cig, agency_fiscal_code, sceltaContraente, pubblicationYear, pubblicationMonth, parse_amount(importoAggiudicazione), parse_amount(importoSommeLiquidate) FROM ' + CONTRACTS + ' LEFT JOIN ' + PROCEDURE_TYPES + ' ON ' + CONTRACTS + '.procedure_id = ' + PROCEDURE_TYPES + '.procedure_id WHERE pubblicationYear = :year AND pubblicationMonth = :month',
+    'INSERT INTO ' + SPEND_BY_AGENCY_MONTH + ' SELECT :year, :month, agency_fiscal_code, count(*), sum(importoAggiudicazione), sum(importoSommeLiquidate) FROM ' + CONTRACT_AMOUNTS + ' WHERE pubblicationYear = :year AND pubblicationMonth = :month GROUP BY agency_fiscal_code',
+    'INSERT INTO ' + SPEND_BY_VENDOR_MONTH + ' SELECT :year, :month, winners.vendor_code, \'vendor\', count(*), sum(importoAggiudicazione), sum(importoSommeLiquidate) FROM ' + CONTRACT_AMOUNTS + ' JOIN ' + WINNERS + ' ON winners.cig = ' + CONTRACT_AMOUNTS + '.cig WHERE pubblicationYear = :year AND pubblicationMonth = :month GROUP BY winners.vendor_code',
+    'INSERT INTO ' + SPEND_BY_VENDOR_MONTH + ' SELECT :year, :month, aggregate_winners.aggregate_vendor_code, \'aggregate_vendor\', count(*), sum(importoAggiudicazione), sum(importoSommeLiquidate) FROM ' + CONTRACT_AMOUNTS + ' JOIN ' + AGGREGATE_WINNERS + ' ON aggregate_winners.cig = ' + CONTRACT_AMOUNTS + '.cig WHERE pubblicationYear = :year AND pubblicationMonth = :month GROUP BY aggregate_winners.aggregate_vendor_code',
+    'INSERT INTO ' + SPEND_BY_PROCEDURE_MONTH + ' SELECT :year, :month, sceltaContraente, count(*), sum(importoAggiudicazione), sum(importoSommeLiquidate) FROM ' + CONTRACT_AMOUNTS + ' WHERE pubblicationYear = :year AND pubblicationMonth = :month GROUP BY sceltaContraente',
+]
+
+#Reconciliation of the names of agencies and vendors (see reconcile_data): for each code and
+#for each of its names (canonical and alternative), the canonical code and name. The names
+#of the placeholder codes (like ND or 99999999999) are linked to the code with the same or a
+#similar name, if there is only one
+RECONCILED_NAMES = 'reconciled_names'
+RECONCILED_NAMES_SCHEMA = [('kind','TEXT'),('code','TEXT'),('name','TEXT'),('canonical_code','TEXT'),
+                           ('canonical_name','TEXT'),('similarity','REAL')]
+#kind, table, code column, name column, alternative names table, alternative name column
+RECONCILED_ENTITIES = [
+    ('agency', PUBLIC_AGENCIES, AGENCY_CODE, 'agency_name', PUBLIC_AGENCIES_ALTERNATIVE_NAMES, 'alternative_agency_name'),
+    ('vendor', VENDORS, VENDOR_CODE, 'vendor_name', VENDORS_ALTERNATIVE_NAMES, 'alternative_vendor_name'),
+]
+PLACEHOLDER_CODES = set(['','ND','N.D.','NA','N.A.','NULL','NONE'])
+PLACEHOLDER_NAME_PREFIXES = ('NoneVendorName','NoneAgencyName')
+#Italian legal forms, replaced by their abbreviation when the names are normalized
+LEGAL_FORMS = [
+    (u"SOCIETA A RESPONSABILITA LIMITATA SEMPLIFICATA",u"SRLS"),
+    (u"SOCIETA A RESPONSABILITA LIMITATA",u"SRL"),
+    (u"SOCIETA PER AZIONI",u"SPA"),
+    (u"SOCIETA IN NOME COLLETTIVO",u"SNC"),
+    (u"SOCIETA IN ACCOMANDITA SEMPLICE",u"SAS"),
+    (u"SOCIETA COOPERATIVA",u"SC"),
+    (u"SOC COOP",u"SC"),
+]
+#Minimum trigram similarity (jaccard) of two names of the same entity
+reconcile_similarity = 0.8
+#Trigrams shared by more names than this are not used to find similar names
+reconcile_max_block_size = 1000
+#Codes with more distinct names than this are not clustered (only the normalized names are compared)
+reconcile_max_forms = 200
+
+#Number of processes parsing the monthly files during extract (1 for a serial extract)
+extract_processes = 1
+#If True, extract loads only the monthly files that changed since the last extract,
+#updating the existing database instead of rebuilding it
+incremental_extract = False
+#When download and extract are run together, each month is parsed as soon as it is
+#downloaded and written as soon as it is parsed (see download_and_extract_data).
+#pipeline_queue_size bounds the months waiting between two stages.
+pipelined_refresh = True
+pipeline_queue_size = 4
+
+#Database buffer: table name -> rows (tuples with the values of the columns of the table, in
+#the order of DATABASE_SCHEMA and without the id column) not yet inserted
 database_buffer = {}
 database_buffer_max_size = 10000
-vendor_codes_to_commit = set()
-vendor_names_to_commit = {}
-agency_codes_to_commit = set()
-agency_names_to_commit = {}
-aggregate_vendor_codes_to_commit = set()
-aggregate_vendor_names_to_commit = {}
+#The tables with the rows of a lotto, whose buffers are flushed together and in this order,
+#so the winners of a contract are inserted after it (see insert_rows). buffered_contracts has
+#the cigs of the contracts in the buffer: the buffers are flushed before buffering a contract
+#published again, so its earlier winners are in the database when it replaces them
+LOTTO_TABLES = [CONTRACTS, WINNERS, AGGREGATE_WINNERS]
+buffered_contracts = set()
+
+#Instrumentation of the run, written as a json report with --report (see run_report):
+#stages run, download/parse/write statistics of each monthly file, table name ->
+#[rows inserted, seconds spent inserting them, insert statements], entity index name ->
+#[lookups, hits] and the number of each kind of warning
+run_statistics = dict(stages=[],months={},tables={},entity_index={},warnings={})
+report_filename = None
+#If True, a progress line is kept updated on stderr
+show_progress = False
+
+#In-memory entity index, kept for the whole extract: code -> canonical name of all the
+#known agencies, vendors and aggregate vendors, and the (code,name) pairs already stored
+#in the alternative names tables
+agency_names_index = {}
+vendor_names_index = {}
+aggregate_vendor_names_index = {}
+agency_alternative_names_index = set()
+vendor_alternative_names_index = set()
+#sceltaContraente -> procedure_id in PROCEDURE_TYPES
+procedure_ids_index = {}
+
+print_lock = threading.Lock()
+
+def locked_print(message):
+    '''Print a message from a worker thread, without interleaving it with other threads output'''
+    with print_lock:
+        print(message)
+
+def print_progress(message):
+    '''Update the progress line on stderr, if show_progress is True'''
+    if( not show_progress ):
+        return
+    with print_lock:
+        sys.stderr.write("\r" + message[:79].ljust(79))
+        sys.stderr.flush()
+
+def end_progress():
+    '''Terminate the progress line, at the end of a stage'''
+    if( show_progress ):
+        sys.stderr.write("\n")
+
+def peak_memory_mb():
+    '''Peak resident memory of this process and of the largest terminated child process
+       (for example a parsing worker) in MB. ru_maxrss is in KB on Linux'''
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss/1024.0
+    return own, children
+
+def month_statistics(filename):
+    '''Get the statistics of a monthly file in the run report'''
+    return run_statistics['months'].setdefault(filename,{})
+
+def record_month_download(filename,result,seconds):
+    '''Record in the run report the outcome, size and time of the download of a monthly file'''
+    statistics = month_statistics(filename)
+    statistics['download_status'] = result['status']
+    statistics['download_bytes'] = result.get('download_size',0)
+    statistics['stored_bytes'] = result.get('size',0)
+    statistics['download_seconds'] = seconds
+    statistics['download_mb_per_second'] = result.get('download_size',0)/1048576.0/max(seconds,0.001)
+    if( 'pieces' in result ):
+        statistics['download_pieces'] = result['pieces']
+
+def record_month_extract(filename,lots,parse_seconds,write_seconds):
+    '''Record in the run report the lots of a monthly file and the time spent parsing them
+       and writing them in the database, and update the progress line'''
+    statistics = month_statistics(filename)
+    statistics['lots'] = lots
+    statistics['parse_seconds'] = parse_seconds
+    statistics['parse_lots_per_second'] = lots/max(parse_seconds,0.001)
+    statistics['write_seconds'] = write_seconds
+    statistics['write_lots_per_second'] = lots/max(write_seconds,0.001)
+    extracted = [month for month in run_statistics['months'].values() if 'lots' in month]
+    print_progress("Extracted " + str(len(extracted)) + " months, " + str(sum([month['lots'] for month in extracted])) + " lots (last " + filename + ")")
+
+def count_warning(warning):
+    '''Count a warning in the run report, instead of printing it for each record'''
+    run_statistics['warnings'][warning] = run_statistics['warnings'].get(warning,0) + 1
+
+def run_report():
+    '''Build the json run report from run_statistics'''
+    tables = {}
+    for table_name, (rows, seconds, inserts) in run_statistics['tables'].items():
+        tables[table_name] = dict(rows=rows,seconds=seconds,inserts=inserts,rows_per_second=rows/max(seconds,0.001),
+                                  seconds_per_insert=seconds/max(inserts,1))
+    entity_index = {}
+    for index_name, (lookups, hits) in run_statistics['entity_index'].items():
+        entity_index[index_name] = dict(lookups=lookups,hits=hits,hit_rate=hits/float(max(lookups,1)))
+    peak_rss_mb, peak_children_rss_mb = peak_memory_mb()
+    return dict(arguments=sys.argv[1:],stages=run_statistics['stages'],months=run_statistics['months'],
+                tables=tables,entity_index=entity_index,warnings=run_statistics['warnings'],
+                peak_rss_mb=peak_rss_mb,peak_children_rss_mb=peak_children_rss_mb)
+
+def write_run_report(filename):
+    '''Write the json run report to filename'''
+    with open(filename,'w') as f:
+        json.dump(run_report(),f,indent=1,sort_keys=True)
+
+def get_http_session():
+    '''Get the HTTP session shared by all the downloads, so that keep-alive connections
+       to the portal are reused instead of opening a new connection for each file'''
+    global http_session
+    if( http_session is None ):
+        http_session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,pool_maxsize=download_workers)
+        http_session.mount("http://",adapter)
+        http_session.mount("https://",adapter)
+    return http_session
 
 #from http://stackoverflow.com/questions/16694907/how-to-download-large-file-in-python-with-requests-py
-def download_file(url,filename=""):
+def download_file(url,filename="",headers=None):
+    '''Download url to filename. The data is written to a temporary file that is renamed
+       to filename only when the download is complete, so an interrupted download never
+       leaves a truncated file. Connection errors and server errors are retried with
+       exponential backoff. Returns a dict with the status of the download
+       ('downloaded' or 'not_modified' if a conditional request was not satisfied),
+       the size and sha1 of the local file and of the downloaded data (they differ if
+       the file is compressed, see open_xml_file) and the HTTP validators sent by the server.'''
     if( filename == "" ):
         local_filename = url.split('/')[-1]
     else:
         local_filename = filename
-    # NOTE the stream=True parameter
-    r = requests.get(url, stream=True)
-    with open(local_filename, 'wb') as f:
-        for chunk in r.iter_content(chunk_size=1024): 
-            if chunk: # filter out keep-alive new chunks
-                f.write(chunk)
-                f.flush()
-    return local_filename
+    temp_filename = local_filename + ".part"
+    attempt = 0
+    while True:
+        r = None
+        try:
+            # NOTE the stream=True parameter
+            r = get_http_session().get(url, stream=True, timeout=download_timeout, headers=headers)
+            r.raise_for_status()
+            if( r.status_code == 304 ):
+                return dict(status='not_modified')
+            size = 0
+            sha1 = hashlib.sha1()
+            lots = 0
+            head = b''
+            tail = b''
+            with open_xml_file(temp_filename,'wb') as f:
+                for chunk in r.iter_content(chunk_size=download_chunk_size):
+                    if chunk: # filter out keep-alive new chunks
+                        f.write(chunk)
+                        sha1.update(chunk)
+                        size = size + len(chunk)
+                        #the lots are counted on the tail of the previous chunk too, for the tags split between two chunks
+                        lots = lots + (tail[-(len(LOTTO_END_TAG)-1):] + chunk).count(LOTTO_END_TAG)
+                        if( len(head) < 4096 ):
+                            head = head + chunk[:4096-len(head)]
+                        tail = (tail + chunk)[-1024:]
+            break
+        except requests.exceptions.RequestException as e:
+            #client errors (4xx) will not be fixed by retrying
+            status_code = getattr(e.response,'status_code',None)
+            attempt = attempt + 1
+            if( (status_code is not None and status_code < 500) or attempt > download_max_retries ):
+                if( os.path.exists(temp_filename) ):
+                    os.remove(temp_filename)
+                raise
+            delay = download_retry_backoff ** attempt
+            locked_print("Error downloading " + local_filename + " (" + str(e) + "), retrying in " + str(delay) + " seconds")
+            time.sleep(delay)
+        finally:
+            if( r is not None ):
+                r.close()
+    if( is_truncated_response(head,tail,lots) ):
+        os.remove(temp_filename)
+        return dict(status='truncated',lots=lots,download_size=size)
+    os.rename(temp_filename,local_filename)
+    download_sha1 = sha1.hexdigest()
+    if( file_compression(local_filename) is None ):
+        file_sha1_value = download_sha1
+    else:
+        file_sha1_value = file_sha1(local_filename)
+    return dict(status='downloaded',size=os.path.getsize(local_filename),sha1=file_sha1_value,
+                download_size=size,download_sha1=download_sha1,lots=lots,
+                etag=r.headers.get('ETag'),last_modified=r.headers.get('Last-Modified'))
+
+def is_truncated_response(head,tail,lots):
+    '''True if a downloaded export, given its first bytes, its last bytes and its number of
+       lots, was truncated by the portal (see portal_result_cap)'''
+    if( portal_result_cap is not None and lots >= portal_result_cap ):
+        return True
+    root = ROOT_ELEMENT_PATTERN.search(head)
+    if( root is None ):
+        #not an xml document
+        return False
+    tail = tail.rstrip()
+    if( lots == 0 and tail.endswith(b"/>") ):
+        return False
+    return not tail.endswith(b"</" + root.group(1) + b">")
+
+def download_export(year,month,closed=True,headers=None):
+    '''Download the export of a month to its xml_filename with download_file. If the response
+       is truncated, the month is downloaded again in pieces split by search key, as finely
+       as needed for each piece to be complete, and the pieces are merged removing the lots
+       found in more than one piece. Returns the result of download_file (for a split month
+       without HTTP validators, as they cannot be used for the next refresh). Raises IOError,
+       leaving the existing file as it is, if the pieces have less lots than the truncated response'''
+    filename = xml_filename(year,month,closed)
+    result = download_file(export_url(year,month,closed),filename,headers)
+    if( result['status'] != 'truncated' ):
+        return result
+    locked_print("The export of " + filename + " was truncated at " + str(result['lots']) + " lots, splitting it by search key")
+    pieces = []
+    try:
+        download_export_pieces(year,month,closed,filename,"",pieces)
+        return merge_export_pieces(filename,pieces,result['lots'])
+    finally:
+        for piece_filename, piece_size in pieces:
+            if( os.path.exists(piece_filename) ):
+                os.remove(piece_filename)
+
+def download_export_pieces(year,month,closed,filename,search_key,pieces,piece_requests=0):
+    '''Download the pieces of the export of a month for the search keys extending search_key
+       with one character, splitting again the truncated ones. Appends the (filename,download
+       size) of the downloaded pieces to pieces. piece_requests is the number of pieces already
+       requested for the month, and the updated number is returned'''
+    if( len(search_key) >= max_search_key_length ):
+        raise IOError("The export of " + filename + " is truncated also for search key " + search_key)
+    for character in SEARCH_KEY_ALPHABET:
+        piece_requests = piece_requests + 1
+        if( piece_requests > max_piece_requests ):
+            raise IOError("The export of " + filename + " needs more than " + str(max_piece_requests) + " pieces")
+        piece_key = search_key + character
+        #the pieces are not compressed, as they are read again by merge_export_pieces
+        piece_filename = filename + ".piece_" + piece_key
+        result = download_file(export_url(year,month,closed,piece_key),piece_filename)
+        if( result['status'] == 'truncated' ):
+            piece_requests = download_export_pieces(year,month,closed,filename,piece_key,pieces,piece_requests)
+        else:
+            pieces.append((piece_filename,result['download_size']))
+    return piece_requests
+
+def merge_export_pieces(filename,pieces,truncated_lots):
+    '''Merge the pieces of a split export in filename: the header and the footer of the
+       document are taken from the first piece with lots, followed by the lots of all the
+       pieces, each CIG only once. Returns a result like the one of download_file. If the
+       merged export has less than the truncated_lots of the truncated response, some lots
+       were not matched by any search key: IOError is raised and filename is not replaced'''
+    temp_filename = filename + ".part"
+    header = None
+    footer = b''
+    seen = set()
+    size = 0
+    sha1 = hashlib.sha1()
+    download_size = 0
+    with open_xml_file(temp_filename,'wb') as output:
+        def write(data):
+            output.write(data)
+            sha1.update(data)
+            return len(data)
+        for piece_filename, piece_size in pieces:
+            download_size = download_size + piece_size
+            #each piece is under the result cap, so it is read at once
+            with open(piece_filename,'rb') as f:
+                data = f.read()
+            start = data.find(LOTTO_START_TAG)
+            if( start < 0 ):
+                continue
+            end = data.rfind(LOTTO_END_TAG) + len(LOTTO_END_TAG)
+            if( header is None ):
+                header = data[:start]
+                footer = data[end:]
+                size = size + write(header)
+            while( start >= 0 and start < end ):
+                lot_end = data.find(LOTTO_END_TAG,start) + len(LOTTO_END_TAG)
+                lot = data[start:lot_end]
+                cig = CIG_PATTERN.search(lot)
+                if( cig is not None ):
+                    key = cig.group(1)
+                else:
+                    key = lot
+                if( key not in seen ):
+                    seen.add(key)
+                    size = size + write(lot)
+                start = data.find(LOTTO_START_TAG,lot_end)
+        if( header is None ):
+            #no lots in the month: the first piece is the whole document
+            with open(pieces[0][0],'rb') as f:
+                size = size + write(f.read())
+        else:
+            size = size + write(footer)
+    if( len(seen) < truncated_lots ):
+        os.remove(temp_filename)
+        raise IOError("The pieces of the export of " + filename + " have " + str(len(seen)) + " lots, less than the " + str(truncated_lots) + " lots of the truncated export")
+    os.rename(temp_filename,filename)
+    download_sha1 = sha1.hexdigest()
+    if( file_compression(filename) is None ):
+        file_sha1_value = download_sha1
+    else:
+        file_sha1_value = file_sha1(filename)
+    return dict(status='downloaded',size=os.path.getsize(filename),sha1=file_sha1_value,
+                download_size=download_size,download_sha1=download_sha1,lots=len(seen),pieces=len(pieces),
+                etag=None,last_modified=None)
+
+def download_files(downloads):
+    '''Download a list of (year,month,closed,headers) months using a bounded pool of download_workers
+       threads. Returns a dict from filename to the result of download_export, or to a
+       dict with status 'failed' if the download failed'''
+    jobs = Queue.Queue()
+    for download in downloads:
+        jobs.put(download)
+    results = {}
+
+    def download_worker():
+        while True:
+            try:
+                year, month, closed, headers = jobs.get_nowait()
+            except Queue.Empty:
+                return
+            filename = xml_filename(year,month,closed)
+            locked_print("Downloading file " + filename)
+            start_time = time.time()
+            try:
+                results[filename] = download_export(year,month,closed,headers)
+            except Exception as e:
+                results[filename] = dict(status='failed',error=str(e))
+            record_month_download(filename,results[filename],time.time() - start_time)
+            print_progress("Downloaded " + str(len(results)) + " of " + str(len(downloads)) + " files")
+
+    threads = []
+    for i in range(min(download_workers,len(downloads))):
+        thread = threading.Thread(target=download_worker)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    end_progress()
+
+    return results
+
+def file_sha1(filename):
+    '''Compute the sha1 of the content of a file'''
+    sha1 = hashlib.sha1()
+    with open(filename,'rb') as f:
+        for chunk in iter(lambda: f.read(download_chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+def file_compression(filename):
+    '''Compression of a monthly file ('gzip', 'zstd' or None), from its extension. The
+       .part extension of the temporary files is ignored'''
+    if( filename.endswith(".part") ):
+        filename = filename[:-len(".part")]
+    for compression_type, extension in COMPRESSED_EXTENSIONS.items():
+        if( filename.endswith(extension) ):
+            return compression_type
+    return None
+
+class CompressedFile(object):
+    '''Minimal binary file object compressing the data written to it, or decompressing the
+       data read from it, one chunk at a time. gzip files are written by zlib with a zero
+       timestamp and no file name, so the same data always gives the same bytes'''
+    def __init__(self,filename,mode,compression_type):
+        self.file = open(filename,mode)
+        self.mode = mode
+        self.buffer = b''
+        self.offset = 0
+        if( mode == 'wb' ):
+            if( compression_type == 'gzip' ):
+                self.compressor = zlib.compressobj(gzip_compression_level,zlib.DEFLATED,16+zlib.MAX_WBITS)
+            else:
+                self.compressor = zstandard.ZstdCompressor(level=zstd_compression_level).compressobj()
+        else:
+            if( compression_type == 'gzip' ):
+                self.decompressor = zlib.decompressobj(16+zlib.MAX_WBITS)
+            else:
+                self.decompressor = zstandard.ZstdDecompressor().decompressobj()
+
+    def write(self,data):
+        self.file.write(self.compressor.compress(data))
+
+    def read(self,size=-1):
+        #decompress a chunk at a time until size bytes are available (or the file ends)
+        while( size < 0 or len(self.buffer) - self.offset < size ):
+            chunk = self.file.read(download_chunk_size)
+            if( not chunk ):
+                break
+            self.buffer = self.buffer[self.offset:] + self.decompressor.decompress(chunk)
+            self.offset = 0
+        if( size < 0 ):
+            size = len(self.buffer) - self.offset
+        data = self.buffer[self.offset:self.offset+size]
+        self.offset = self.offset + len(data)
+        return data
+
+    def close(self):
+        if( self.file.closed ):
+            return
+        if( self.mode == 'wb' ):
+            self.file.write(self.compressor.flush())
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.close()
+
+def open_xml_file(filename,mode='rb'):
+    '''Open a monthly file for reading ('rb') or writing ('wb'), decompressing or compressing
+       it as a stream according to its extension (see file_compression)'''
+    compression_type = file_compression(filename)
+    if( compression_type is None ):
+        return open(filename,mode,download_chunk_size)
+    if( compression_type == 'zstd' and zstandard is None ):
+        raise IOError("zstandard library needed to open " + filename)
+    return CompressedFile(filename,mode,compression_type)
+
+def load_manifest():
+    '''Load the download manifest, a dict from filename to the information of the last download'''
+    if( not os.path.exists(manifest_filename) ):
+        return {}
+    with open(manifest_filename,'r') as f:
+        return json.load(f)
+
+def save_manifest(manifest):
+    '''Save the download manifest, atomically replacing the old one'''
+    temp_filename = manifest_filename + ".part"
+    with open(temp_filename,'w') as f:
+        json.dump(manifest,f,indent=1,sort_keys=True)
+    os.rename(temp_filename,manifest_filename)
+
+def update_manifest_file_hash(manifest,filename):
+    '''Record in the manifest the size and hash of the local copy of filename, to be
+       called after the file is modified locally (for example by indent_data)'''
+    entry = manifest.setdefault(filename,{})
+    entry['size'] = os.path.getsize(filename)
+    entry['mtime'] = os.path.getmtime(filename)
+    entry['sha1'] = file_sha1(filename)
+
+def is_recent_month(year,month):
+    '''True if the month is one of the last recent_months_to_refresh months (or in the future)'''
+    today = datetime.date.today()
+    months_ago = (today.year-year)*12 + (today.month-month)
+    return months_ago < recent_months_to_refresh
+
+def month_download_action(manifest,year,month,closed=True):
+    '''Decide how to refresh a month: 'download' it if it is new or if the local copy does not
+       match the manifest, 'revalidate' it with a conditional request if it may have changed
+       on the portal (recent months and active tenders), otherwise 'skip' it. A file recorded
+       only by indent or push (without fetched_at) was never downloaded with the manifest, so
+       it is downloaded again'''
+    filename = xml_filename(year,month,closed)
+    if( force_download or filename not in manifest or not os.path.exists(filename) ):
+        return 'download'
+    if( manifest[filename].get('fetched_at') is None ):
+        return 'download'
+    if( manifest[filename].get('size') != os.path.getsize(filename) ):
+        return 'download'
+    if( not closed or is_recent_month(year,month) ):
+        return 'revalidate'
+    return 'skip'
+
+def conditional_request_headers(manifest_entry):
+    '''HTTP headers for a conditional request using the validators recorded in the manifest'''
+    headers = {}
+    if( manifest_entry.get('etag') is not None ):
+        headers['If-None-Match'] = manifest_entry['etag']
+    if( manifest_entry.get('last_modified') is not None ):
+        headers['If-Modified-Since'] = manifest_entry['last_modified']
+    return headers
 
 def iso_pubblication_date(pubblication_year,pubblication_month,separator="-"):
     return str(pubblication_year)+separator+'%02d' % pubblication_month;
 
 def xml_filename(year,month,closed=True):
     if( closed ):
-        return "avcp_contracts_"+iso_pubblication_date(year,month,"_")+".xml";
+        filename = "avcp_contracts_"+iso_pubblication_date(year,month,"_")+".xml";
     else:
-        return "avcp_contracts_"+iso_pubblication_date(year,month,"_")+"_open.xml";
+        filename = "avcp_contracts_"+iso_pubblication_date(year,month,"_")+"_open.xml";
+    if( compression is not None ):
+        filename = filename + COMPRESSED_EXTENSIONS[compression]
+    return filename
 
-def push_data_to_github():
+def export_url(year,month,closed=True,search_key="-100"):
+    '''Get the portal export URL of the tenders of a given month (closed or active tenders),
+       for all the tenders or only for the ones matching search_key'''
+    if( closed ):
+        tender_state = "0"
+    else:
+        tender_state = "1"
+    return avcp_export_url+"?valuepromptanswers="+search_key+"^"+str(year)+"^"+str(month)+"^"+tender_state
+
+def plan_month_downloads(manifest,closed=True):
+    '''Plan the refresh of the months in years_to_download, returning a list of
+       (year,month,filename,action,headers) in month order (see month_download_action)'''
+    planned = []
     for year in years_to_download:
         for month in months_in_a_year:
-            subprocess.call(["git","add",xml_filename(year,month)])
-    
-    commit_msg = "Data updated at " + datetime.datetime.now().isoformat()
-    subprocess.call(["git","commit","-m",commit_msg])
-    subprocess.call(["git","config","user.email",git_email])
-    subprocess.call(["git","push"])
- 
-    return
+            filename = xml_filename(year,month,closed)
+            action = month_download_action(manifest,year,month,closed)
+            headers = {}
+            if( action == 'revalidate' ):
+                headers = conditional_request_headers(manifest[filename])
+            planned.append((year,month,filename,action,headers))
+    return planned
+
+def record_download_result(manifest,filename,result):
+    '''Update the manifest with the result of a download_file of filename. Returns the
+       outcome of the download ('changed', 'not_modified' or 'failed') for the summary'''
+    now = datetime.datetime.now().isoformat()
+    if( result['status'] == 'failed' ):
+        print("Error: download of " + filename + " failed (" + result['error'] + ")")
+        return 'failed'
+    old_entry = manifest.get(filename,{})
+    if( result['status'] == 'not_modified' ):
+        old_entry['checked_at'] = now
+        return 'not_modified'
+    manifest[filename] = dict(size=result['size'],sha1=result['sha1'],download_sha1=result['download_sha1'],
+                              etag=result['etag'],last_modified=result['last_modified'],
+                              lots=result.get('lots'),fetched_at=now,checked_at=now)
+    for key in ['published_sha1','published_lots']:
+        if( key in old_entry ):
+            manifest[filename][key] = old_entry[key]
+    if( old_entry.get('download_sha1') == result['download_sha1'] ):
+        return 'not_modified'
+    return 'changed'
+
+def download_months(closed=True):
+    '''Download the data of the months in years_to_download that are new, recent or changed,
+       concurrently, and update the download manifest'''
+    manifest = load_manifest()
+    downloads = []
+    skipped = []
+    for year, month, filename, action, headers in plan_month_downloads(manifest,closed):
+        if( action == 'skip' ):
+            print("Skipping " + filename + " (fetched at " + str(manifest[filename].get('fetched_at')) + ")")
+            skipped.append(filename)
+        else:
+            downloads.append((year,month,closed,headers))
+
+    results = download_files(downloads)
+
+    outcomes = dict(changed=0,not_modified=0,failed=0)
+    for year, month, closed, headers in downloads:
+        filename = xml_filename(year,month,closed)
+        outcome = record_download_result(manifest,filename,results[filename])
+        outcomes[outcome] = outcomes[outcome] + 1
+    save_manifest(manifest)
+
+    print("Downloaded " + str(outcomes['changed']) + " new or changed files, " + str(outcomes['not_modified']) + " files not modified, skipped " + str(len(skipped)) + " files")
+    if( outcomes['failed'] > 0 ):
+        raise IOError("Failed to download " + str(outcomes['failed']) + " files")
+
+def count_lots(filename):
+    '''Count the lots of a monthly file, reading it as a stream'''
+    lots = 0
+    previous = b''
+    with open_xml_file(filename) as f:
+        while True:
+            chunk = f.read(download_chunk_size)
+            if( not chunk ):
+                break
+            #the end of the previous chunk is counted too, for the tags split between two chunks
+            lots = lots + (previous + chunk).count(LOTTO_END_TAG)
+            previous = chunk[-(len(LOTTO_END_TAG)-1):]
+    return lots
+
+def data_files():
+    '''Get the existing monthly files of closed and open tenders of years_to_download'''
+    filenames = []
+    for year in years_to_download:
+        for month in months_in_a_year:
+            for closed in [True,False]:
+                filename = xml_filename(year,month,closed)
+                if( os.path.exists(filename) ):
+                    filenames.append(filename)
+    return filenames
+
+def changed_data_files(manifest):
+    '''Get the data files whose content changed since they were last published by push, comparing
+       the sha1 of the manifest with the published one. The sha1 is computed again only for the
+       files whose size or modification time does not match the manifest'''
+    changed = []
+    for filename in data_files():
+        entry = manifest.setdefault(filename,{})
+        if( entry.get('size') != os.path.getsize(filename) or entry.get('mtime') != os.path.getmtime(filename) ):
+            sha1 = entry.get('sha1')
+            update_manifest_file_hash(manifest,filename)
+            if( entry['sha1'] != sha1 ):
+                entry.pop('lots',None)
+        if( entry['sha1'] != entry.get('published_sha1') ):
+            changed.append(filename)
+    return changed
+
+def publish_commit_message(manifest,changed):
+    '''Build the message of the commit of the changed data files, with the lots of each of them
+       and their difference with the lots last published'''
+    lines = []
+    for filename in changed:
+        entry = manifest[filename]
+        if( entry.get('lots') is None ):
+            entry['lots'] = count_lots(filename)
+        line = filename + ": " + str(entry['lots']) + " lots"
+        if( entry.get('published_lots') is not None ):
+            line = line + " (" + "%+d" % (entry['lots'] - entry['published_lots']) + ")"
+        lines.append(line)
+    return "\n".join(["Data updated at " + datetime.datetime.now().isoformat() + ", " + str(len(changed)) + " changed files",""] + lines)
+
+def push_data_to_github():
+    '''Publish the data files changed since the last push (see changed_data_files) with a single
+       git add, commit and push. Nothing is committed or pushed if no file changed'''
+    manifest = load_manifest()
+    try:
+        changed = changed_data_files(manifest)
+        if( len(changed) == 0 ):
+            print("No data changed since the last push, nothing to publish")
+            return
+        print("Publishing " + str(len(changed)) + " changed files")
+        subprocess.check_call(["git","add","--"] + changed)
+        #the changed files are already committed if the push of a previous run failed
+        if( subprocess.call(["git","diff","--cached","--quiet","--"] + changed) != 0 ):
+            git_command = ["git"]
+            if( git_email is not None ):
+                git_command = git_command + ["-c","user.email=" + git_email]
+            subprocess.check_call(git_command + ["commit","-m",publish_commit_message(manifest,changed),"--"] + changed)
+        subprocess.check_call(["git","push"])
+        for filename in changed:
+            manifest[filename]['published_sha1'] = manifest[filename]['sha1']
+            manifest[filename]['published_lots'] = manifest[filename].get('lots')
+    finally:
+        save_manifest(manifest)
   
+class StreamingIndenter(xml.sax.handler.ContentHandler):
+    '''SAX handler writing an indented copy of the parsed document to a binary file while it
+       is parsed. The whitespace between elements is replaced by the indentation, the text of
+       the elements without children is kept as it is and the attributes are sorted, so
+       indenting an already indented document gives exactly the same bytes'''
+    def __init__(self,output,indent="  "):
+        xml.sax.handler.ContentHandler.__init__(self)
+        self.output = output
+        self.indent = indent
+        #for each open element, True if it has child elements
+        self.open_elements = []
+        self.text = []
+
+    def write(self,data):
+        self.output.write(data.encode('utf-8'))
+
+    def startDocument(self):
+        self.write(u'<?xml version="1.0" encoding="utf-8"?>\n')
+
+    def startElement(self,name,attrs):
+        depth = len(self.open_elements)
+        if( depth > 0 ):
+            if( not self.open_elements[-1] ):
+                #first child: close the start tag of the parent
+                self.write(u">\n")
+                self.open_elements[-1] = True
+            self.write_mixed_text(depth)
+        self.text = []
+        self.write(self.indent*depth + u"<" + name)
+        for attribute_name in sorted(attrs.getNames()):
+            self.write(u" " + attribute_name + u"=" + xml.sax.saxutils.quoteattr(attrs.getValue(attribute_name)))
+        self.open_elements.append(False)
+
+    def endElement(self,name):
+        has_children = self.open_elements.pop()
+        depth = len(self.open_elements)
+        if( has_children ):
+            self.write_mixed_text(depth+1)
+            self.write(self.indent*depth + u"</" + name + u">\n")
+        else:
+            text = u"".join(self.text)
+            if( len(text) == 0 ):
+                self.write(u"/>\n")
+            else:
+                self.write(u">" + xml.sax.saxutils.escape(text) + u"</" + name + u">\n")
+        self.text = []
+
+    def write_mixed_text(self,depth):
+        '''Write on its own line the text found between the children of an element, if it
+           is not only whitespace'''
+        text = u"".join(self.text).strip()
+        if( len(text) > 0 ):
+            self.write(self.indent*depth + xml.sax.saxutils.escape(text) + u"\n")
+        self.text = []
+
+    def characters(self,content):
+        self.text.append(content)
+
+def indent_file(filename):
+    '''Indent an xml file with StreamingIndenter, writing to a temporary file that replaces
+       filename only if it is different. Compressed files are decompressed and compressed
+       again as a stream. Returns True if the file was changed'''
+    temp_filename = filename + ".part"
+    parser = xml.sax.make_parser()
+    parser.setFeature(xml.sax.handler.feature_external_ges,False)
+    with open_xml_file(temp_filename,'wb') as output:
+        with open_xml_file(filename) as source:
+            parser.setContentHandler(StreamingIndenter(output))
+            parser.parse(source)
+    if( filecmp.cmp(temp_filename,filename,shallow=False) ):
+        os.remove(temp_filename)
+        return False
+    os.rename(temp_filename,filename)
+    return True
+
+def is_indented(manifest,filename):
+    '''True if the manifest records that filename was already indented, and it was not changed since then'''
+    entry = manifest.get(filename)
+    if( entry is None or entry.get('indented_sha1') is None ):
+        return False
+    return entry['indented_sha1'] == entry.get('sha1') and entry.get('size') == os.path.getsize(filename)
+
 def indent_data():
+    manifest = load_manifest()
     for year in years_to_download:
         for month in months_in_a_year:
             filename = xml_filename(year,month)
+            if( is_indented(manifest,filename) ):
+                print("Skipping " + filename + " (already indented)")
+                continue
             print("Indenting " + filename);
-            xml_dom = xml.dom.minidom.parse(filename) 
-            pretty_xml_as_string = xml_dom.toprettyxml(indent="  ")
-            f = codecs.open(filename,'w','utf-8')
-            f.write(pretty_xml_as_string)
-            f.close()
+            if( not indent_file(filename) ):
+                print(filename + " was already indented")
+            update_manifest_file_hash(manifest,filename)
+            manifest[filename]['indented_sha1'] = manifest[filename]['sha1']
+    save_manifest(manifest)
 
 def download_data():
     '''Download all the data available in AVCP http://portaletrasparenza.avcp.it for closed tenders
        in raw xml data. The data is splitted at each month to avoid reaching
        the maximum query limit'''
     print("Downloading data of closed tenders")
+    download_months(True)
 
-    for year in years_to_download:
-        for month in months_in_a_year:
-            url = "http://portaletrasparenza.avcp.it/Microstrategy/asp/export_xml.aspx?valuepromptanswers=-100^"+str(year)+"^"+str(month)+"^0"
-            print("Downloading file " + xml_filename(year,month));
-            download_file(url,xml_filename(year,month,True))
-            
 def download_data_active_tenders():
     print("Downloading data of active tenders")
-    
-    for year in years_to_download:
-        for month in months_in_a_year:
-            url = "http://portaletrasparenza.avcp.it/Microstrategy/asp/export_xml.aspx?valuepromptanswers=-100^"+str(year)+"^"+str(month)+"^1"
-            print("Downloading file " + xml_filename(year,month));
-            download_file(url,xml_filename(year,month,False))
-            
+    download_months(False)
+
 def dataset_result_to_list_of_dict(dataset_result):
     return_value = []
     for result in dataset_result:
         return_value.append(result)
     return return_value
 
-def buffered_insert(table,record,table_name):
-    '''Insert a record in the table, but using an internal buffer to reduce the number of insert statements'''
-    global agency_codes_to_commit
-    global agency_names_to_commit
-    global vendor_codes_to_commit
-    global vendor_names_to_commit
-    global aggregate_vendor_codes_to_commit
-    global aggregate_vendor_names_to_commit
-    
+def table_columns(table_name):
+    '''Get the names of the columns of a table of DATABASE_SCHEMA'''
+    for name, columns in DATABASE_SCHEMA:
+        if( name == table_name ):
+            return [column_name for column_name, column_type in columns]
+
+def create_database_tables(db):
+    '''Create the tables of DATABASE_SCHEMA, if they do not exist'''
+    for table_name, columns in DATABASE_SCHEMA:
+        column_definitions = [column_name + " " + column_type for column_name, column_type in columns]
+        db.execute("CREATE TABLE IF NOT EXISTS " + table_name + " (" + ", ".join(column_definitions) + ")")
+
+def open_bulk_load_database(filename):
+    '''Create a new database for a bulk load: the schema is created up front and all
+       the rows are then inserted in a single transaction, without journal and without
+       waiting for the disk (the database is rebuilt from scratch if the load fails)'''
+    db = sqlite3.connect(filename,isolation_level=None)
+    db.execute("PRAGMA journal_mode=OFF")
+    db.execute("PRAGMA synchronous=OFF")
+    db.execute("PRAGMA temp_store=MEMORY")
+    db.execute("PRAGMA cache_size=-262144")
+    create_database_tables(db)
+    db.execute("BEGIN")
+    return db
+
+def open_incremental_database(filename):
+    '''Open the database for an incremental extract. The database is kept in WAL mode and
+       each month is loaded in its own transaction, so the database can be queried while
+       the extract is running'''
+    db = sqlite3.connect(filename,isolation_level=None)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute("PRAGMA temp_store=MEMORY")
+    db.execute("PRAGMA cache_size=-262144")
+    #INSERT OR REPLACE fires the delete triggers of the full text index only with recursive triggers
+    db.execute("PRAGMA recursive_triggers=ON")
+    if( is_outdated_database(db) ):
+        print("Error: the database was created by an older version of this script, run a full extract")
+        sys.exit(1)
+    create_database_tables(db)
+    create_database_indexes(db)
+    if( full_text_index or has_full_text_index(db) ):
+        create_full_text_index(db)
+    return db
+
+def is_outdated_database(db):
+    '''True if the database has the tables of an older version of this script (some table of
+       DATABASE_SCHEMA is missing or has different columns)'''
+    if( db.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?",(CONTRACTS,)).fetchone() is None ):
+        return False
+    for table_name, columns in DATABASE_SCHEMA:
+        if( [column[1] for column in db.execute("PRAGMA table_info(" + table_name + ")")] != table_columns(table_name) ):
+            return True
+    return False
+
+def create_database_indexes(db):
+    '''Build the secondary indexes of DATABASE_INDEXES'''
+    for table_name, column_names in DATABASE_INDEXES:
+        print("Creating index on " + ", ".join(column_names) + " of table " + table_name)
+        db.execute("CREATE INDEX IF NOT EXISTS " + table_name + "_" + "_".join(column_names) + "_index ON " + table_name + " (" + ", ".join(column_names) + ")")
+
+def has_full_text_index(db):
+    '''True if the database has the full text index'''
+    return db.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?",(CONTRACTS_FTS,)).fetchone() is not None
+
+def create_full_text_index(db):
+    '''Create the tables and triggers of FULL_TEXT_INDEX_SCHEMA, if they do not exist. If the index
+       is new, the contracts already in the database are indexed'''
+    created = not has_full_text_index(db)
+    try:
+        for statement in FULL_TEXT_INDEX_SCHEMA:
+            db.execute(statement)
+    except sqlite3.OperationalError as e:
+        print("Error: the full text index needs a sqlite library with the FTS5 extension (" + str(e) + ")")
+        sys.exit(1)
+    if( created ):
+        print("Building the full text index of " + CONTRACTS)
+        db.execute("INSERT INTO " + CONTRACTS_FTS + " (" + CONTRACTS_FTS + ") VALUES ('rebuild')")
+
+def update_entity_names_index(db):
+    '''Index again all the names of agencies, vendors and aggregate vendors in ENTITY_NAMES_FTS'''
+    print("Building the full text index of the names")
+    db.execute("BEGIN")
+    db.execute("DELETE FROM " + ENTITY_NAMES_FTS)
+    db.execute("INSERT INTO " + ENTITY_NAMES_FTS + " (name, kind, code) " + ENTITY_NAMES_QUERY)
+    db.execute("COMMIT")
+
+def insert_rows(db,table_name,rows):
+    '''Insert a list of rows (tuples with the values of the columns of the table, without the id
+       column) in a table with a single executemany. The rows replace the existing ones with the
+       same primary key (for example a contract published again in a later month), both in a
+       full and in an incremental extract. The winners and aggregate winners of the replaced
+       contracts are deleted, as a later publication can have another kind of winner (the new
+       winners are inserted after the contracts, see LOTTO_TABLES)'''
+    columns = [column_name for column_name in table_columns(table_name) if column_name != 'id']
+    insert_statement = "INSERT OR REPLACE INTO " + table_name + " (" + ", ".join(columns) + ") VALUES (" + ", ".join(["?"]*len(columns)) + ")"
+    start_time = time.time()
+    if( table_name == CONTRACTS ):
+        cigs = [(row[0],) for row in rows]
+        db.executemany("DELETE FROM " + WINNERS + " WHERE " + CIG_CODE_NAME + " = ?",cigs)
+        db.executemany("DELETE FROM " + AGGREGATE_WINNERS + " WHERE " + CIG_CODE_NAME + " = ?",cigs)
+    db.executemany(insert_statement,rows)
+    statistics = run_statistics['tables'].setdefault(table_name,[0,0.0,0])
+    statistics[0] = statistics[0] + len(rows)
+    statistics[1] = statistics[1] + time.time() - start_time
+    statistics[2] = statistics[2] + 1
+
+def print_load_statistics():
+    '''Print the number of rows inserted in each table, and the insert rate'''
+    for table_name, columns in DATABASE_SCHEMA:
+        if( table_name in run_statistics['tables'] ):
+            rows, seconds, inserts = run_statistics['tables'][table_name]
+            print("Loaded " + str(rows) + " rows in table " + table_name + " in " + "%.2f" % seconds + " seconds (" + str(int(rows/max(seconds,0.001))) + " rows/s)")
+
+def buffered_insert(db,row,table_name):
+    '''Insert a row (see insert_rows) in the table, but using an internal buffer to reduce the number of insert statements'''
+    #a contract published again is buffered after its earlier publication is inserted
+    if( table_name == CONTRACTS ):
+        if( row[0] in buffered_contracts ):
+            flush_lotto_buffers(db)
+        buffered_contracts.add(row[0])
+
     #create buffer if it does not exist
-    if( table_name not in database_buffer.keys() ):
-        database_buffer[table_name] = []
-        
-    database_buffer[table_name].append(record)
-    
-    if( table_name == VENDORS ):
-        vendor_codes_to_commit.add(record[VENDOR_CODE])
-        vendor_names_to_commit[record[VENDOR_CODE]] = record['vendor_name']
-        
-    if( table_name == PUBLIC_AGENCIES ):
-        agency_codes_to_commit.add(record[AGENCY_CODE])
-        agency_names_to_commit[record[AGENCY_CODE]] = record['agency_name']
-        
-    if( table_name == AGGREGATE_VENDORS ):
-        aggregate_vendor_codes_to_commit.add(record[AGGREGATE_VENDOR_CODE])
-        aggregate_vendor_names_to_commit[record[AGGREGATE_VENDOR_CODE]] = record['aggregate_vendor_name']
-    
-    if( len(database_buffer[table_name]) > database_buffer_max_size ):
-        print("Inserting rows for table " + table_name)
-        table.insert_many(rows=database_buffer[table_name])
-        database_buffer[table_name] = []
-        
-        if( table_name == VENDORS ):
-            vendor_codes_to_commit = set()
-            vendor_names_to_commit = {}
+    rows = database_buffer.get(table_name)
+    if( rows is None ):
+        rows = database_buffer[table_name] = []
         
-        if( table_name == PUBLIC_AGENCIES ):
-            agency_codes_to_commit = set()
-            agency_names_to_commit = {}
+    rows.append(row)
     
+    if( len(rows) > database_buffer_max_size ):
+        if( table_name in LOTTO_TABLES ):
+            flush_lotto_buffers(db)
+        else:
+            insert_rows(db,table_name,rows)
+            database_buffer[table_name] = []
     
+def flush_lotto_buffers(db):
+    '''Insert the buffered rows of all the LOTTO_TABLES, in order'''
+    for table_name in LOTTO_TABLES:
+        if( len(database_buffer.get(table_name,[])) > 0 ):
+            insert_rows(db,table_name,database_buffer[table_name])
+            database_buffer[table_name] = []
+    buffered_contracts.clear()
 
-def flush_table_buffer(table,table_name):
+def flush_table_buffer(db,table_name):
     '''Flush buffer, for being sure that all uncommitted records are inserted in the database'''
-    if( table_name in database_buffer.keys() ):
+    if( table_name in database_buffer.keys() and len(database_buffer[table_name]) > 0 ):
         print("Flushing " + str(len(database_buffer[table_name])) + " elements of table " + table_name);
-        table.insert_many(rows=database_buffer[table_name])
+        insert_rows(db,table_name,database_buffer[table_name])
         database_buffer[table_name] = []
+    if( table_name == CONTRACTS ):
+        buffered_contracts.clear()
 
-def get_vendor_name(vendors_table,new_vendor_code):
-    '''Get the vendor name given a vendor code, or None if the vendor_code is not present in the database'''
-    if( new_vendor_code in vendor_codes_to_commit ):
-        return vendor_names_to_commit[new_vendor_code]
-    
-    result = vendors_table.find_one(vendor_code=new_vendor_code)
+def reset_entity_index():
+    '''Empty the in-memory entity index, at the beginning of an extract'''
+    agency_names_index.clear()
+    vendor_names_index.clear()
+    aggregate_vendor_names_index.clear()
+    agency_alternative_names_index.clear()
+    vendor_alternative_names_index.clear()
+    procedure_ids_index.clear()
 
-    if( result is None ):
-        return None
-    else:
-        return result['vendor_name']
-    
+def load_entity_index(db):
+    '''Load in the in-memory entity index the agencies, vendors, aggregate vendors and
+       alternative names already in the database, at the beginning of an incremental extract'''
+    reset_entity_index()
+    for code, name in db.execute("SELECT " + AGENCY_CODE + ", agency_name FROM " + PUBLIC_AGENCIES):
+        agency_names_index[code] = name
+    for code, name in db.execute("SELECT " + VENDOR_CODE + ", vendor_name FROM " + VENDORS):
+        vendor_names_index[code] = name
+    for code, name in db.execute("SELECT " + AGGREGATE_VENDOR_CODE + ", aggregate_vendor_name FROM " + AGGREGATE_VENDORS):
+        aggregate_vendor_names_index[code] = name
+    for code, name in db.execute("SELECT " + AGENCY_CODE + ", alternative_agency_name FROM " + PUBLIC_AGENCIES_ALTERNATIVE_NAMES):
+        agency_alternative_names_index.add((code,name))
+    for code, name in db.execute("SELECT " + VENDOR_CODE + ", alternative_vendor_name FROM " + VENDORS_ALTERNATIVE_NAMES):
+        vendor_alternative_names_index.add((code,name))
+    for procedure_id, scelta_contraente in db.execute("SELECT procedure_id, sceltaContraente FROM " + PROCEDURE_TYPES):
+        procedure_ids_index[scelta_contraente] = procedure_id
 
-def get_aggregate_vendor_name(aggregate_vendors_table,new_aggregate_vendor_code):
-    '''Get the aggregate vendor name given a vendor code, or None if the aggregate_vendor_code is not present in the database'''
-    if( new_aggregate_vendor_code in aggregate_vendor_codes_to_commit ):
-        return aggregate_vendor_names_to_commit[new_aggregate_vendor_code]
-    
-    result = aggregate_vendors_table.find_one(aggregate_vendor_code=new_aggregate_vendor_code)
+def count_entity_lookup(index_name,found_name):
+    '''Count a lookup in the entity index, and if it found a known entity, for the run report'''
+    statistics = run_statistics['entity_index'].get(index_name)
+    if( statistics is None ):
+        statistics = run_statistics['entity_index'][index_name] = [0,0]
+    statistics[0] = statistics[0] + 1
+    if( found_name is not None ):
+        statistics[1] = statistics[1] + 1
+    return found_name
 
-    if( result is None ):
+def get_procedure_id(db,scelta_contraente):
+    '''Get the procedure_id of a sceltaContraente, adding it to PROCEDURE_TYPES if it is new'''
+    if( scelta_contraente is None ):
         return None
-    else:
-        return result['aggregate_vendor_name']
+    procedure_id = procedure_ids_index.get(scelta_contraente)
+    if( procedure_id is None ):
+        #the ids are never deleted, so they are 1..len(procedure_ids_index)
+        procedure_id = len(procedure_ids_index) + 1
+        buffered_insert(db,(procedure_id,scelta_contraente),PROCEDURE_TYPES)
+        procedure_ids_index[scelta_contraente] = procedure_id
+    return procedure_id
+
+def get_vendor_name(new_vendor_code):
+    '''Get the vendor name given a vendor code, or None if the vendor_code is not present in the database'''
+    return count_entity_lookup(VENDORS,vendor_names_index.get(new_vendor_code))
+
+def get_aggregate_vendor_name(new_aggregate_vendor_code):
+    '''Get the aggregate vendor name given a vendor code, or None if the aggregate_vendor_code is not present in the database'''
+    return count_entity_lookup(AGGREGATE_VENDORS,aggregate_vendor_names_index.get(new_aggregate_vendor_code))
     
-def get_agency_name(agencies_table,new_agency_code):
+def get_agency_name(new_agency_code):
     '''Get the agency name given a agency code, or None if the agency_code is not present in the database'''
-    if( new_agency_code in agency_codes_to_commit ):
-        return agency_names_to_commit[new_agency_code]
-    
-    result = agencies_table.find_one(agency_fiscal_code=new_agency_code)
-
-    if( result is None ):
-        return None
-    else:
-        return result['agency_name']
+    return count_entity_lookup(PUBLIC_AGENCIES,agency_names_index.get(new_agency_code))
     
 def add_vendor(db,new_vendor_code,new_vendor_name,foreign_vendor=False):
     '''Add a vendor, if the vendor_code is already in the database and the vendor name does not match,
        add the vendor name to VENDORS_ALTERNATIVE_NAMES table'''
-    vendors_table = db.get_table(VENDORS)
-    vendors_alternative_names_table = db.get_table(VENDORS_ALTERNATIVE_NAMES)
-    
     if( new_vendor_name is None ):
         new_vendor_name = "NoneVendorName"+new_vendor_code;
     
@@ -252,35 +1335,28 @@ def add_vendor(db,new_vendor_code,new_vendor_name,foreign_vendor=False):
 
     #print("Called add_vendor with vendor_name " + new_vendor_name)
 
-    found_vendor_name = get_vendor_name(vendors_table,new_vendor_code);
+    found_vendor_name = get_vendor_name(new_vendor_code);
     
     if( found_vendor_name is None ):
         #adding a new vendor to the table
-        vendor_row = {}
-        vendor_row[VENDOR_CODE] = new_vendor_code
-        vendor_row['vendor_name'] = new_vendor_name
         if( not foreign_vendor ):
-            vendor_row['vendor_country'] = "ITALY"
+            vendor_country = "ITALY"
         else:
-            vendor_row['vendor_country'] = "NOT ITALY"
+            vendor_country = "NOT ITALY"
         #vendors_table.insert(vendor_row)
-        buffered_insert(vendors_table,vendor_row,VENDORS);
+        buffered_insert(db,(new_vendor_code,new_vendor_name,vendor_country),VENDORS);
+        vendor_names_index[new_vendor_code] = new_vendor_name
         
     else:
-        #vendor already present, if with another name adding the alternative name to vendors_alternative_names_table
-        if( not( found_vendor_name == new_vendor_name ) ):
-            alternative_name_row = {}
-            alternative_name_row[VENDOR_CODE] = new_vendor_code
-            alternative_name_row['alternative_vendor_name'] = new_vendor_name
+        #vendor already present, if with another name not already seen adding the alternative name to vendors_alternative_names_table
+        if( not( found_vendor_name == new_vendor_name ) and (new_vendor_code,new_vendor_name) not in vendor_alternative_names_index ):
+            vendor_alternative_names_index.add((new_vendor_code,new_vendor_name))
             #vendors_alternative_names_table.insert(alternative_name_row);
-            buffered_insert(vendors_alternative_names_table,alternative_name_row,VENDORS_ALTERNATIVE_NAMES)
+            buffered_insert(db,(new_vendor_code,new_vendor_name),VENDORS_ALTERNATIVE_NAMES)
             
 def add_agency(db,new_agency_code,new_agency_name):
     '''Add an agency, if the new_agency_code is already in the database and the agency name does not match,
        add the agency name to PUBLIC_AGENCIES_ALTERNATIVE_NAMES table'''
-    agencies_table = db.get_table(PUBLIC_AGENCIES)
-    agencies_alternative_names_table = db.get_table(PUBLIC_AGENCIES_ALTERNATIVE_NAMES)
-    
     if( new_agency_name is None ):
         new_agency_name = "NoneAgencyName"+new_agency_code;
 
@@ -289,41 +1365,34 @@ def add_agency(db,new_agency_code,new_agency_name):
 
     #print("Called add_agency with new_agency_name " + new_agency_name + " and new_agency_code " + new_agency_code)
 
-    found_agency_name = get_agency_name(agencies_table,new_agency_code);
+    found_agency_name = get_agency_name(new_agency_code);
 
     if( found_agency_name is None ):
         #adding a new vendor to the table
-        agency_row = {}
-        agency_row[AGENCY_CODE] = unicode(new_agency_code)
-        agency_row['agency_name'] = unicode(new_agency_name)
+        agency_name = unicode(new_agency_name)
         #agencies_table.insert(agency_row)
-        buffered_insert(agencies_table,agency_row,PUBLIC_AGENCIES);
+        buffered_insert(db,(unicode(new_agency_code),agency_name),PUBLIC_AGENCIES);
+        agency_names_index[new_agency_code] = agency_name
     else:
-        #vendor already present, if with another name adding the alternative name to vendors_alternative_names_table
-        if( not( found_agency_name == new_agency_name ) ):
-            alternative_name_row = {}
-            alternative_name_row[AGENCY_CODE] = new_agency_code
-            alternative_name_row['alternative_agency_name'] = new_agency_name
+        #vendor already present, if with another name not already seen adding the alternative name to vendors_alternative_names_table
+        if( not( found_agency_name == new_agency_name ) and (new_agency_code,new_agency_name) not in agency_alternative_names_index ):
+            agency_alternative_names_index.add((new_agency_code,new_agency_name))
             #agencies_alternative_names_table.insert(alternative_name_row);
-            buffered_insert(agencies_alternative_names_table,alternative_name_row,PUBLIC_AGENCIES_ALTERNATIVE_NAMES)
+            buffered_insert(db,(new_agency_code,new_agency_name),PUBLIC_AGENCIES_ALTERNATIVE_NAMES)
 
 def add_aggregate_vendor(db,aggregate_vendors_dict):
-    vendors_table = db.get_table(VENDORS)
-    aggregate_vendors_table = db.get_table(AGGREGATE_VENDORS)
-    aggregate_winners_table = db.get_table(AGGREGATE_WINNERS)
-    aggregate_vendors_dict.sort(lambda x,y : cmp(x['code'], y['code']))
+    aggregate_vendors_dict.sort(lambda x,y : cmp(x[0], y[0]))
     aggregate_vendor_code = ""
     aggregate_vendor_name = ""
     first_item = True
     for item in aggregate_vendors_dict:
         if( first_item ):
-            aggregate_vendor_code = item["code"]
+            aggregate_vendor_code = item[0]
         else:
-            aggregate_vendor_code = aggregate_vendor_code+"-"+item["code"]
-        found_vendor_name = get_vendor_name(vendors_table,item["code"]);
+            aggregate_vendor_code = aggregate_vendor_code+"-"+item[0]
+        found_vendor_name = get_vendor_name(item[0]);
         if( found_vendor_name is None ):
             assert(False)
-        print("Vendor name: " + found_vendor_name)
         
         if( first_item ):
             aggregate_vendor_name = found_vendor_name
@@ -332,155 +1401,920 @@ def add_aggregate_vendor(db,aggregate_vendors_dict):
         first_item = False
 
     
-    print("Called add_aggregate_vendor: " + aggregate_vendor_name + " ( " + aggregate_vendor_code + " ) ")
-    
-    found_aggregate_vendor_name = get_aggregate_vendor_name(aggregate_vendors_table,aggregate_vendor_code);
+    found_aggregate_vendor_name = get_aggregate_vendor_name(aggregate_vendor_code);
 
     if( found_aggregate_vendor_name is None ):
-        aggregate_vendor_row = {}
-        aggregate_vendor_row[AGGREGATE_VENDOR_CODE] = aggregate_vendor_code
-        aggregate_vendor_row['aggregate_vendor_name'] = aggregate_vendor_name
-        buffered_insert(aggregate_vendors_table,aggregate_vendor_row,AGGREGATE_VENDORS)
+        buffered_insert(db,(aggregate_vendor_code,aggregate_vendor_name),AGGREGATE_VENDORS)
+        for item in aggregate_vendors_dict:
+            buffered_insert(db,(aggregate_vendor_code,item[0],item[3]),AGGREGATE_VENDOR_MEMBERS)
+        aggregate_vendor_names_index[aggregate_vendor_code] = aggregate_vendor_name
         
     return aggregate_vendor_code
 
-def extract_data_from_file(db,filename,pubblication_year,pubblication_month):
-    '''Extract data from a file to the given database'''
+def first_children(element):
+    '''Map the tag of each child of element to the first child with that tag, so that
+       every child of a lotto is looked up only once'''
+    children = {}
+    for child in element:
+        if( child.tag not in children ):
+            children[child.tag] = child
+    return children
+
+def shared_text(strings,element):
+    '''Get the text of an element, as the same string object of the equal texts already
+       seen (strings maps each text to itself), so that the codes, names and other values
+       repeated in many lots are kept in memory only once'''
+    text = element.text
+    return strings.setdefault(text,text)
+
+def vendor_record(vendor_children,strings,role=None):
+    '''Extract a (code,name,foreign,role) tuple of a vendor from the children of an aggiudicatario
+       or membro element (see first_children)'''
+    if( 'codiceFiscale' not in vendor_children ):
+        #foreign vendor
+        return (shared_text(strings,vendor_children['identificativoFiscaleEstero']),
+                shared_text(strings,vendor_children['ragioneSociale']),True,role)
+    return (shared_text(strings,vendor_children['codiceFiscale']),
+            shared_text(strings,vendor_children['ragioneSociale']),False,role)
+
+def lotto_record(lotto,strings):
+    '''Convert a lotto element to a flat contract record, the tuple (cig, oggetto, sceltaContraente,
+       importoAggiudicazione, importoSommeLiquidate, agency code, agency name, vendor, consortium)
+       with the single winner (see vendor_record, or None) and the tuple of the members of the
+       winning consortium (or None). Plain tuples take less memory than dicts and are faster to
+       send from the worker processes, and the repeated texts are shared through strings (see shared_text)'''
+    children = first_children(lotto)
+    struttura_proponente = first_children(children['strutturaProponente'])
+    vendor = None
+    consortium = None
+
+    aggiudicatari = children.get('aggiudicatari')
+    if( aggiudicatari is not None ):
+        winners = first_children(aggiudicatari)
+        if( 'aggiudicatario' in winners ):
+            aggiudicatario = first_children(winners['aggiudicatario'])
+            if( 'ragioneSociale' in aggiudicatario ):
+                vendor = vendor_record(aggiudicatario,strings)
+        raggruppamento = winners.get('aggiudicatarioRaggruppamento')
+        if( raggruppamento is not None and raggruppamento.find('membro') is not None ):
+            consortium = []
+            for membro in raggruppamento.iter('membro'):
+                membro_children = first_children(membro)
+                consortium.append(vendor_record(membro_children,strings,shared_text(strings,membro_children['ruolo'])))
+            consortium = tuple(consortium)
+
+    return (children['cig'].text,children['oggetto'].text,
+            shared_text(strings,children['sceltaContraente']),
+            shared_text(strings,children['importoAggiudicazione']),
+            shared_text(strings,children['importoSommeLiquidate']),
+            shared_text(strings,struttura_proponente['codiceFiscaleProp']),
+            shared_text(strings,struttura_proponente['denominazione']),
+            vendor,consortium)
+
+def iter_lotto_records(filename):
+    '''Stream the lotto elements of an AVCP xml file with iterparse, yielding a record
+       (see lotto_record) for each of them. Each lotto is removed from the tree after use,
+       so the memory used does not depend on the size of the file (compressed files are
+       decompressed as a stream)'''
+    open_elements = []
+    strings = {}
+    with open_xml_file(filename) as source:
+        for event, element in ElementTree.iterparse(source,events=('start','end')):
+            if( event == 'start' ):
+                open_elements.append(element)
+                continue
+            open_elements.pop()
+            if( element.tag == 'lotto' ):
+                yield lotto_record(element,strings)
+                element.clear()
+                if( len(open_elements) > 0 ):
+                    open_elements[-1].remove(element)
+
+def is_published_later(db,cig,pubblication_year,pubblication_month):
+    '''In an incremental extract, True if the contract is already in the database from a month
+       later than the one being loaded. Its rows are kept, as in a full extract, where the
+       months are loaded in order and the latest publication of a contract replaces the others'''
+    if( not incremental_extract ):
+        return False
+    row = db.execute("SELECT pubblicationYear, pubblicationMonth FROM " + CONTRACTS + " WHERE " + CIG_CODE_NAME + " = ?",(cig,)).fetchone()
+    return row is not None and (row[0],row[1]) > (pubblication_year,pubblication_month)
+
+def insert_lotto_record(db,record,pubblication_year,pubblication_month):
+    '''Insert in the database a record extracted from a lotto (see lotto_record), together
+       with its public agency and winners'''
+    cig, oggetto, scelta_contraente, importo_aggiudicazione, importo_somme_liquidate, agency_code, agency_name, vendor, consortium = record
+    #inserting the contract, unless it is already loaded from a later month
+    if( len(cig) > 10 ):
+        count_warning("CIG not conformant to the AVCP specification")
+    published_later = is_published_later(db,cig,pubblication_year,pubblication_month)
+    #contracts_table.insert(contract_row)
+    if( not published_later ):
+        buffered_insert(db,(cig,oggetto,get_procedure_id(db,scelta_contraente),importo_aggiudicazione,importo_somme_liquidate,
+                            agency_code,pubblication_month,pubblication_year,iso_pubblication_date(pubblication_year,pubblication_month)),CONTRACTS);
     
-    #load tables from database 
-    public_agencies_table = db.get_table(PUBLIC_AGENCIES)
-    vendors_table = db.get_table(VENDORS)
-    aggregate_vendors_table = db.get_table(AGGREGATE_VENDORS)
-    contracts_table = db.get_table(CONTRACTS)
-    winners_table = db.get_table(WINNERS)
-    aggregate_winners_table = db.get_table(AGGREGATE_WINNERS)
-    public_agencies_alternative_names_table = db.get_table(PUBLIC_AGENCIES_ALTERNATIVE_NAMES)
-    vendors_alternative_names_table = db.get_table(VENDORS_ALTERNATIVE_NAMES)
+    #inserting the public agency (if present)
+    add_agency(db,agency_code,agency_name)
     
+    #inserting the winner (if present)
+    if( vendor is not None ):
+        vendor_code, vendor_name, foreign_vendor, role = vendor
+        add_vendor(db,vendor_code,vendor_name,foreign_vendor)
+        #adding winner
+        if( not published_later ):
+            buffered_insert(db,(cig,vendor_code),WINNERS)
+            
+    if( consortium is not None ):
+        for membro_code, membro_name, foreign_membro, role in consortium:
+            add_vendor(db,membro_code,membro_name,foreign_membro);
+        aggregate_vendor_code = add_aggregate_vendor(db,list(consortium));
+        if( not published_later ):
+            buffered_insert(db,(cig,aggregate_vendor_code),AGGREGATE_WINNERS)
+
+def extract_data_from_file(db,filename,pubblication_year,pubblication_month):
+    '''Extract data from a file to the given database, returning the number of lots extracted'''
     print("extract_data_from_file of year " + str(pubblication_year) + " month " + str(pubblication_month))
     
-    tree = xml.etree.ElementTree.parse(filename)
-    root = tree.getroot()
-    for lotto in root.iter('lotto'):
-        #inserting the contract
-        contract_row = {}
-        if( len(lotto.find('cig').text) > 10 ):
-            print("Warning: CIG " + lotto.find('cig').text + " not conformant to the AVCP specification")
-        contract_row[CIG_CODE_NAME] = lotto.find('cig').text
-        contract_row['oggetto'] = lotto.find('oggetto').text 
-        contract_row['sceltaContraente'] = lotto.find('sceltaContraente').text
-        contract_row['importoAggiudicazione'] = lotto.find('importoAggiudicazione').text
-        contract_row['importoSommeLiquidate'] = lotto.find('importoSommeLiquidate').text
-        contract_row[AGENCY_CODE] = lotto.find('strutturaProponente').find('codiceFiscaleProp').text
-        contract_row['pubblicationMonth'] = pubblication_month
-        contract_row['pubblicationYear'] = pubblication_year
-        contract_row['pubblication_date'] = iso_pubblication_date(pubblication_year,pubblication_month)
-        #contracts_table.insert(contract_row)
-        buffered_insert(contracts_table,contract_row,CONTRACTS);
-        
-        #inserting the public agency (if present)
-        agency_code = lotto.find('strutturaProponente').find('codiceFiscaleProp').text
-        agency_name = lotto.find('strutturaProponente').find('denominazione').text
-        add_agency(db,agency_code,agency_name)
-        
-        #inserting the winner (if present)
-        if( lotto.find('aggiudicatari') is not None ):
-            if( lotto.find('aggiudicatari').find('aggiudicatario') is not None and lotto.find('aggiudicatari').find('aggiudicatario').find('ragioneSociale') is not None ):
-                if( lotto.find('aggiudicatari').find('aggiudicatario').find('codiceFiscale') is None ):
-                    #Foreing vendor 
-                    vendor_code = lotto.find('aggiudicatari').find('aggiudicatario').find('identificativoFiscaleEstero').text
-                    vendor_foreigner = True
-                else:
-                    vendor_code = lotto.find('aggiudicatari').find('aggiudicatario').find('codiceFiscale').text
-                    vendor_foreigner = False
-                vendor_name = lotto.find('aggiudicatari').find('aggiudicatario').find('ragioneSociale').text
-                add_vendor(db,vendor_code,vendor_name,vendor_foreigner)
-                #adding winner
-                winner_row = {}
-                winner_row[CIG_CODE_NAME] = contract_row[CIG_CODE_NAME]
-                winner_row[VENDOR_CODE] = vendor_code
-                buffered_insert(winners_table,winner_row,WINNERS)
-                
-            if( lotto.find('aggiudicatari').find('aggiudicatarioRaggruppamento') is not None):
-                if( lotto.find('aggiudicatari').find('aggiudicatarioRaggruppamento').find('membro') is not None ):
-                    raggruppamento = lotto.find('aggiudicatari').find('aggiudicatarioRaggruppamento');
-                    aggregate_vendors_dict = []
-                    for membro in raggruppamento.iter('membro'):
-                        if( membro.find('codiceFiscale') is None):
-                            #foreign vendor 
-                            vendor_code = membro.find('identificativoFiscaleEstero').text
-                            vendor_foreigner = True
-                        else:
-                            vendor_code = membro.find('codiceFiscale').text
-                            vendor_foreigner = False
-                        vendor_name = membro.find('ragioneSociale').text;
-                        vendor_role = membro.find('ruolo').text;
-                        add_vendor(db,vendor_code,vendor_name,vendor_foreigner);
-                        aggregate_vendors_dict.append(dict(code=vendor_code,role=vendor_role));
-                    aggregate_vendor_code = add_aggregate_vendor(db,aggregate_vendors_dict);
-                    winner_row = {}
-                    winner_row[CIG_CODE_NAME] = contract_row[CIG_CODE_NAME]
-                    winner_row[AGGREGATE_VENDOR_CODE] = aggregate_vendor_code
-                    buffered_insert(aggregate_winners_table,winner_row,AGGREGATE_WINNERS)
-                 
-         
-    
+    lots = 0
+    start_time = time.time()
+    write_seconds = 0.0
+    for record in iter_lotto_records(filename):
+        write_start_time = time.time()
+        insert_lotto_record(db,record,pubblication_year,pubblication_month)
+        write_seconds = write_seconds + time.time() - write_start_time
+        lots = lots + 1
+    record_month_extract(filename,lots,time.time() - start_time - write_seconds,write_seconds)
+    return lots
+
+def begin_month_load(db,month_file):
+    '''In an incremental extract, start the transaction loading a month and delete the contracts
+       and winners previously loaded for it. Agencies and vendors are kept, as they can be
+       referenced by other months. A contract removed from the month is not loaded again from an
+       earlier month publishing it too, that only a full extract does'''
+    if( not incremental_extract ):
+        return
+    filename, pubblication_year, pubblication_month, sha1 = month_file
+    db.execute("BEGIN")
+    month_contracts = "SELECT " + CIG_CODE_NAME + " FROM " + CONTRACTS + " WHERE pubblicationYear = ? AND pubblicationMonth = ?"
+    db.execute("DELETE FROM " + WINNERS + " WHERE " + CIG_CODE_NAME + " IN (" + month_contracts + ")",(pubblication_year,pubblication_month))
+    db.execute("DELETE FROM " + AGGREGATE_WINNERS + " WHERE " + CIG_CODE_NAME + " IN (" + month_contracts + ")",(pubblication_year,pubblication_month))
+    db.execute("DELETE FROM " + CONTRACTS + " WHERE pubblicationYear = ? AND pubblicationMonth = ?",(pubblication_year,pubblication_month))
+
+def end_month_load(db,month_file,lots):
+    '''Record the monthly file as loaded. In an incremental extract, write all the buffered
+       rows and commit the transaction of the month'''
+    filename, pubblication_year, pubblication_month, sha1 = month_file
+    buffered_insert(db,(filename,pubblication_year,pubblication_month,sha1,lots,datetime.datetime.now().isoformat()),SOURCE_FILES)
+    if( incremental_extract ):
+        for table_name, columns in DATABASE_SCHEMA:
+            flush_table_buffer(db,table_name)
+        db.execute("COMMIT")
+
+def parse_month_file(month_file):
+    '''Parse a (filename,year,month,sha1) monthly file in a worker process, returning all its
+       records and the seconds spent parsing them'''
+    filename, pubblication_year, pubblication_month, sha1 = month_file
+    start_time = time.time()
+    records = list(iter_lotto_records(filename))
+    return records, time.time() - start_time
+
+def extract_data_parallel(db,pool,month_files):
+    '''Parse the (filename,year,month,sha1) monthly files with a pool of processes, and merge the
+       parsed records in the database from this process. The months are merged in the same
+       order of a serial extract, so agencies, vendors and alternative names are reconciled
+       in the same way. At most 2*extract_processes parsed months are kept in memory.'''
+    pending = collections.deque()
+    for month_file in month_files:
+        pending.append((month_file,pool.apply_async(parse_month_file,(month_file,))))
+        if( len(pending) >= 2*extract_processes ):
+            merge_parsed_month(db,pending.popleft())
+    while( len(pending) > 0 ):
+        merge_parsed_month(db,pending.popleft())
+
+def merge_parsed_month(db,parsed_month):
+    '''Insert in the database the records of a month parsed by parse_month_file. Returns the
+       number of records, the seconds spent parsing them, the seconds waited for the parsing
+       to complete and the seconds spent writing them'''
+    month_file, result = parsed_month
+    filename, pubblication_year, pubblication_month, sha1 = month_file
+    start_time = time.time()
+    records, parse_seconds = result.get()
+    wait_seconds = time.time() - start_time
+    print("Merging " + str(len(records)) + " records of year " + str(pubblication_year) + " month " + str(pubblication_month))
+    start_time = time.time()
+    begin_month_load(db,month_file)
+    for record in records:
+        insert_lotto_record(db,record,pubblication_year,pubblication_month)
+    end_month_load(db,month_file,len(records))
+    write_seconds = time.time() - start_time
+    record_month_extract(filename,len(records),parse_seconds,write_seconds)
+    return len(records), parse_seconds, wait_seconds, write_seconds
+
+def loaded_source_files():
+    '''Get a dict from filename to the sha1 of the monthly files already loaded in the database'''
+    loaded = {}
+    if( not os.path.exists(database_name) ):
+        return loaded
+    db = sqlite3.connect(database_name)
+    try:
+        if( db.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?",(SOURCE_FILES,)).fetchone() is not None ):
+            for filename, sha1 in db.execute("SELECT filename, sha1 FROM " + SOURCE_FILES):
+                loaded[filename] = sha1
+    finally:
+        db.close()
+    return loaded
+
+def is_month_loaded(loaded,month_file):
+    '''In an incremental extract, True if the (filename,year,month,sha1) monthly file is already
+       loaded in the database (loaded is the result of loaded_source_files)'''
+    filename, year, month, sha1 = month_file
+    if( incremental_extract and loaded.get(filename) == sha1 ):
+        print("Skipping year " + str(year) + " month " + str(month) + " (already loaded)")
+        return True
+    return False
+
+def open_extract_database():
+    '''Open the database for an extract: the existing database for an incremental extract,
+       otherwise a new database for a bulk load in bulk_load_database_name (see close_extract_database)'''
+    if( incremental_extract ):
+        db = open_incremental_database(database_name)
+        load_entity_index(db)
+    else:
+        #left by a failed extract
+        if( os.path.exists(bulk_load_database_name) ):
+            os.remove(bulk_load_database_name)
+        reset_entity_index()
+        #public agencies data should be loaded from indicepa
+        db = open_bulk_load_database(bulk_load_database_name)
+    return db
+
+def replace_database():
+    '''Replace the database with the one built by a full extract in bulk_load_database_name. The
+       files of the write-ahead log of the previous database are removed, as they do not
+       belong to the new one'''
+    for filename in [database_name+"-wal",database_name+"-shm"]:
+        if( os.path.exists(filename) ):
+            os.remove(filename)
+    os.rename(bulk_load_database_name,database_name)
+
+def close_extract_database(db):
+    '''Complete an extract: write the buffered rows and build the indexes after a bulk load, and
+       update the full text index of the names (the contracts are indexed by triggers in an
+       incremental extract, and all at once after a bulk load). The database built by a bulk
+       load replaces the previous one only at the end, after it is complete'''
+    if( not incremental_extract ):
+        for table_name, columns in DATABASE_SCHEMA:
+            flush_table_buffer(db,table_name)
+        db.execute("COMMIT")
+        create_database_indexes(db)
+        if( full_text_index ):
+            create_full_text_index(db)
+    if( has_full_text_index(db) ):
+        update_entity_names_index(db)
+    #a new generation of the data, that invalidates the caches of the query service (see avcp_query.py)
+    db.execute("PRAGMA user_version = " + str(db.execute("PRAGMA user_version").fetchone()[0] + 1))
+
+    db.close()
+    if( not incremental_extract ):
+        replace_database()
+    end_progress()
+    print_load_statistics()
+
 def extract_data():
-    '''Extract data from the downloaded xml files'''
-    subprocess.call(['rm',database_name])
-    
-    
-    db = dataset.connect(database_url)
-    
-    #this data should be loaded from indicepa
-    db.create_table(PUBLIC_AGENCIES, primary_id=AGENCY_CODE, primary_type='Text')
-    db.create_table(VENDORS, primary_id=VENDOR_CODE,primary_type='Text')
-    db.create_table(AGGREGATE_VENDORS,primary_id='aggregate_vendor_code',primary_type='Text')
-    db.create_table(CONTRACTS, primary_id=CIG_CODE_NAME, primary_type='Text')
-    db.create_table(WINNERS, primary_id=CIG_CODE_NAME, primary_type='Text')
-    db.create_table(AGGREGATE_WINNERS, primary_id=CIG_CODE_NAME, primary_type='Text')
-    db.create_table(PUBLIC_AGENCIES_ALTERNATIVE_NAMES)
-    db.create_table(VENDORS_ALTERNATIVE_NAMES)
-    
-    
+    '''Extract data from the downloaded xml files. If extract_processes is greater than one,
+       the files are parsed in parallel (see extract_data_parallel). If incremental_extract
+       is True, only the files changed since the last extract are loaded in the existing database'''
+    loaded = {}
+    if( incremental_extract ):
+        loaded = loaded_source_files()
+    month_files = []
     for year in years_to_download:
         for month in months_in_a_year:
             filename = xml_filename(year,month)
-            extract_data_from_file(db,filename,year,month)
-            
-    flush_table_buffer(db.get_table(PUBLIC_AGENCIES),PUBLIC_AGENCIES);
-    flush_table_buffer(db.get_table(VENDORS),VENDORS);
-    flush_table_buffer(db.get_table(AGGREGATE_VENDORS),AGGREGATE_VENDORS);
-    flush_table_buffer(db.get_table(CONTRACTS),CONTRACTS);
-    flush_table_buffer(db.get_table(WINNERS),WINNERS);
-    flush_table_buffer(db.get_table(AGGREGATE_WINNERS),AGGREGATE_WINNERS);
-    flush_table_buffer(db.get_table(PUBLIC_AGENCIES_ALTERNATIVE_NAMES),PUBLIC_AGENCIES_ALTERNATIVE_NAMES);
-    flush_table_buffer(db.get_table(VENDORS_ALTERNATIVE_NAMES),VENDORS_ALTERNATIVE_NAMES);
+            month_file = (filename,year,month,file_sha1(filename))
+            if( not is_month_loaded(loaded,month_file) ):
+                month_files.append(month_file)
 
+    #the worker processes are started before opening the database, so they do not share its connection
+    pool = None
+    if( extract_processes > 1 and len(month_files) > 1 ):
+        pool = multiprocessing.Pool(extract_processes)
 
-def dump_all_winners():
+    db = open_extract_database()
     
+    if( pool is None ):
+        for month_file in month_files:
+            filename, year, month, sha1 = month_file
+            begin_month_load(db,month_file)
+            lots = extract_data_from_file(db,filename,year,month)
+            end_month_load(db,month_file,lots)
+    else:
+        try:
+            extract_data_parallel(db,pool,month_files)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    close_extract_database(db)
+
+def download_and_extract_data():
+    '''Download and extract the data of closed tenders as a pipeline: a pool of threads
+       downloads the months in order, each month is parsed by a pool of processes as soon
+       as its download completes, and this process writes the parsed months in order as
+       soon as they are available. At most pipeline_queue_size months are downloaded and not
+       yet parsed (besides the download_workers in progress), and at most pipeline_queue_size
+       months are being parsed and not yet written, so
+       a slow stage blocks the previous ones. The throughput of each stage and the time it
+       was blocked by the other stages are printed at the end.'''
+    print("Downloading and extracting data of closed tenders")
+    manifest = load_manifest()
+    planned = plan_month_downloads(manifest,True)
+    loaded = {}
+    if( incremental_extract ):
+        loaded = loaded_source_files()
+
+    jobs = Queue.Queue()
+    for planned_month in planned:
+        jobs.put(planned_month)
+    download_results = {}
+    downloaded = {}
+    for year, month, filename, action, headers in planned:
+        downloaded[filename] = threading.Event()
+    #a download slot is taken before taking the next month from jobs and released when the
+    #month is consumed, so the month being waited for always has a slot
+    download_slots = threading.Semaphore(download_workers+pipeline_queue_size)
+    download_statistics = dict(files=0,bytes=0,seconds=0.0,blocked_seconds=0.0)
+    statistics_lock = threading.Lock()
+
+    def download_worker():
+        while True:
+            start_time = time.time()
+            download_slots.acquire()
+            blocked_seconds = time.time() - start_time
+            try:
+                year, month, filename, action, headers = jobs.get_nowait()
+            except Queue.Empty:
+                download_slots.release()
+                return
+            start_time = time.time()
+            if( action == 'skip' ):
+                result = dict(status='skipped')
+            else:
+                locked_print("Downloading file " + filename)
+                try:
+                    result = download_export(year,month,True,headers)
+                except Exception as e:
+                    result = dict(status='failed',error=str(e))
+                record_month_download(filename,result,time.time() - start_time)
+            with statistics_lock:
+                download_statistics['blocked_seconds'] = download_statistics['blocked_seconds'] + blocked_seconds
+                if( action != 'skip' ):
+                    download_statistics['files'] = download_statistics['files'] + 1
+                    download_statistics['bytes'] = download_statistics['bytes'] + result.get('download_size',0)
+                    download_statistics['seconds'] = download_statistics['seconds'] + time.time() - start_time
+            download_results[filename] = result
+            downloaded[filename].set()
+
+    #the worker processes are started before opening the database, so they do not share its connection
+    pool = multiprocessing.Pool(max(1,extract_processes))
+    db = open_extract_database()
+
+    threads = []
+    for i in range(min(download_workers,len(planned))):
+        thread = threading.Thread(target=download_worker)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    parse_statistics = dict(months=0,lots=0,seconds=0.0)
+    write_statistics = dict(lots=0,seconds=0.0,download_wait_seconds=0.0,parse_wait_seconds=0.0)
+
+    def write_parsed_month(parsed_month):
+        lots, parse_seconds, wait_seconds, write_seconds = merge_parsed_month(db,parsed_month)
+        parse_statistics['months'] = parse_statistics['months'] + 1
+        parse_statistics['lots'] = parse_statistics['lots'] + lots
+        parse_statistics['seconds'] = parse_statistics['seconds'] + parse_seconds
+        write_statistics['lots'] = write_statistics['lots'] + lots
+        write_statistics['seconds'] = write_statistics['seconds'] + write_seconds
+        write_statistics['parse_wait_seconds'] = write_statistics['parse_wait_seconds'] + wait_seconds
+
+    try:
+        pending = collections.deque()
+        for year, month, filename, action, headers in planned:
+            start_time = time.time()
+            downloaded[filename].wait()
+            write_statistics['download_wait_seconds'] = write_statistics['download_wait_seconds'] + time.time() - start_time
+            download_slots.release()
+            result = download_results[filename]
+            if( result['status'] == 'skipped' ):
+                print("Skipping download of " + filename + " (fetched at " + str(manifest[filename].get('fetched_at')) + ")")
+            elif( record_download_result(manifest,filename,result) == 'failed' ):
+                raise IOError("Failed to download " + filename)
+
+            sha1 = manifest[filename].get('sha1')
+            if( sha1 is None or manifest[filename].get('size') != os.path.getsize(filename) ):
+                sha1 = file_sha1(filename)
+            month_file = (filename,year,month,sha1)
+            if( is_month_loaded(loaded,month_file) ):
+                continue
+            pending.append((month_file,pool.apply_async(parse_month_file,(month_file,))))
+            if( len(pending) >= pipeline_queue_size ):
+                write_parsed_month(pending.popleft())
+        while( len(pending) > 0 ):
+            write_parsed_month(pending.popleft())
+        pool.close()
+    finally:
+        save_manifest(manifest)
+        pool.terminate()
+        pool.join()
+
+    close_extract_database(db)
+
+    print("Download stage: " + str(download_statistics['files']) + " files, " + "%.1f" % (download_statistics['bytes']/1048576.0) + " MB in " + "%.2f" % download_statistics['seconds'] + " thread-seconds (" + "%.2f" % (download_statistics['bytes']/1048576.0/max(download_statistics['seconds'],0.001)) + " MB/s), blocked by backpressure for " + "%.2f" % download_statistics['blocked_seconds'] + " thread-seconds")
+    print("Parse stage: " + str(parse_statistics['months']) + " months, " + str(parse_statistics['lots']) + " lots in " + "%.2f" % parse_statistics['seconds'] + " process-seconds (" + str(int(parse_statistics['lots']/max(parse_statistics['seconds'],0.001))) + " lots/s)")
+    print("Write stage: " + str(write_statistics['lots']) + " lots in " + "%.2f" % write_statistics['seconds'] + " seconds (" + str(int(write_statistics['lots']/max(write_statistics['seconds'],0.001))) + " lots/s), waited " + "%.2f" % write_statistics['download_wait_seconds'] + " seconds for downloads and " + "%.2f" % write_statistics['parse_wait_seconds'] + " seconds for parsing")
+
+
+def dump_all_winners():
+    '''Materialize ALL_WINNERS_QUERY in the all_winners table, replacing it if it exists'''
     db = dataset.connect(database_url)
     
-    db.query('CREATE TABLE all_winners AS SELECT winners.cig AS cig, vendors.vendor_code AS vendor_code, vendors.vendor_name AS vendor_name FROM winners JOIN vendors ON winners.vendor_code = vendors.vendor_code UNION SELECT aggregate_winners.cig AS cig, aggregate_vendors.aggregate_vendor_code AS vendor_code, aggregate_vendors.aggregate_vendor_name AS vendor_name FROM aggregate_winners JOIN aggregate_vendors ON aggregate_winners.aggregate_vendor_code = aggregate_vendors.aggregate_vendor_code');
+    db.query('DROP TABLE IF EXISTS all_winners');
+    db.query('CREATE TABLE all_winners AS ' + ALL_WINNERS_QUERY);
+    db.query('CREATE INDEX all_winners_cig_index ON all_winners (cig)');
+
+def is_placeholder_code(code):
+    '''True if a fiscal code is a placeholder (like ND or 99999999999) and not a real code'''
+    if( code is None ):
+        return True
+    code = code.strip().upper()
+    return code in PLACEHOLDER_CODES or code.strip('0') == '' or code.strip('9') == ''
+
+def is_placeholder_name(name):
+    '''True if a name is missing (see add_vendor and add_agency)'''
+    return name is None or name.startswith(PLACEHOLDER_NAME_PREFIXES)
+
+def name_blocking_key(name):
+    '''Normalize a name for the comparisons: uppercase without accents and punctuation, with the
+       single letters joined (S.R.L. becomes SRL), the legal forms abbreviated and the words sorted'''
+    name = unicode(name)
+    try:
+        name.encode('ascii')
+    except UnicodeError:
+        name = unicodedata.normalize('NFKD',name)
+        name = u"".join([c for c in name if not unicodedata.combining(c)])
+    name = name.upper()
+    words = []
+    letters = u""
+    for word in re.findall(r"[^\W_]+",name,re.UNICODE):
+        if( len(word) == 1 and word.isalpha() ):
+            letters = letters + word
+            continue
+        if( len(letters) > 0 ):
+            words.append(letters)
+            letters = u""
+        words.append(word)
+    if( len(letters) > 0 ):
+        words.append(letters)
+    normalized = u" " + u" ".join(words) + u" "
+    for long_form, short_form in LEGAL_FORMS:
+        normalized = normalized.replace(u" " + long_form + u" ",u" " + short_form + u" ")
+    return u" ".join(sorted(set(normalized.split())))
+
+def name_trigrams(key):
+    '''Set of the character trigrams of a name blocking key'''
+    key = u" " + key + u" "
+    return set([key[i:i+3] for i in range(len(key)-2)])
+
+def trigram_similarity(trigrams1,trigrams2):
+    '''Jaccard similarity of two sets of trigrams'''
+    if( len(trigrams1) == 0 or len(trigrams2) == 0 ):
+        return 0.0
+    shared = len(trigrams1 & trigrams2)
+    return shared/float(len(trigrams1) + len(trigrams2) - shared)
+
+def canonical_name(names,name_keys):
+    '''Choose the canonical name among the names of a code (the first is the one seen first),
+       given their blocking keys. The names are grouped by blocking key and the keys are clustered
+       by trigram similarity: the canonical name is the first name of the cluster with most names,
+       the placeholder names are used only if there are no other names. Returns the index of the
+       canonical name in names'''
+    indexes = [i for i, name in enumerate(names) if not is_placeholder_name(name)] or range(len(names))
+    keys = collections.OrderedDict()
+    for i in indexes:
+        keys.setdefault(name_keys[i],[]).append(i)
+    if( len(keys) == 1 or len(keys) > reconcile_max_forms ):
+        return indexes[0]
+    key_list = list(keys.keys())
+    trigrams = [name_trigrams(key) for key in key_list]
+    #each cluster is numbered by its first key
+    cluster = list(range(len(key_list)))
+    for i in range(len(key_list)):
+        for j in range(i):
+            if( cluster[i] != cluster[j] and trigram_similarity(trigrams[i],trigrams[j]) >= reconcile_similarity ):
+                merged_cluster = max(cluster[i],cluster[j])
+                cluster = [min(cluster[i],cluster[j]) if c == merged_cluster else c for c in cluster]
+    sizes = collections.Counter()
+    for i, key in enumerate(key_list):
+        sizes[cluster[i]] = sizes[cluster[i]] + len(keys[key])
+    #the ties go to the cluster of the first name seen
+    best_cluster = min(sizes.keys(),key=lambda c: (-sizes[c],c))
+    return keys[key_list[cluster.index(best_cluster)]][0]
+
+class NameBlockingIndex(object):
+    '''Index of the blocking keys of the names of the real codes, to find the code of a name
+       without comparing it with all the names: the exact key is looked up in a dict, the
+       similar keys are found through the lists of keys containing each trigram (without the
+       trigrams shared by more than reconcile_max_block_size keys)'''
+    def __init__(self):
+        self.key_codes = {}
+        self.keys = []
+        self.key_sizes = array.array('i')
+        self.postings = {}
+
+    def add(self,key,code):
+        codes = self.key_codes.get(key)
+        if( codes is None ):
+            codes = self.key_codes[key] = set()
+            key_id = len(self.keys)
+            self.keys.append(key)
+            trigrams = name_trigrams(key)
+            self.key_sizes.append(len(trigrams))
+            for trigram in trigrams:
+                posting = self.postings.get(trigram)
+                if( posting is None ):
+                    posting = self.postings[trigram] = array.array('i')
+                posting.append(key_id)
+        codes.add(code)
+
+    def find_code(self,key):
+        '''Find the code of a name, returning (code,similarity), or (None,0.0) if there is no
+           similar name or if the most similar names belong to different codes'''
+        codes = self.key_codes.get(key)
+        if( codes is not None ):
+            if( len(codes) == 1 ):
+                return list(codes)[0], 1.0
+            return None, 0.0
+        trigrams = name_trigrams(key)
+        shared = collections.Counter()
+        for trigram in trigrams:
+            posting = self.postings.get(trigram)
+            if( posting is not None and len(posting) <= reconcile_max_block_size ):
+                shared.update(posting)
+        best_similarity = 0.0
+        best_codes = set()
+        for key_id, count in shared.items():
+            similarity = count/float(len(trigrams) + self.key_sizes[key_id] - count)
+            if( similarity > best_similarity ):
+                best_similarity = similarity
+                best_codes = set(self.key_codes[self.keys[key_id]])
+            elif( similarity == best_similarity ):
+                best_codes.update(self.key_codes[self.keys[key_id]])
+        if( best_similarity < reconcile_similarity or len(best_codes) != 1 ):
+            return None, 0.0
+        return list(best_codes)[0], best_similarity
+
+def reconcile_names(names_by_code):
+    '''Reconcile the names of a kind of entity, given an ordered dict from code to its names
+       (the canonical one first). Returns a list of (code,name,canonical_code,canonical_name,
+       similarity) for all the names, and the number of names of placeholder codes linked to
+       a real code'''
+    canonical_names = {}
+    index = NameBlockingIndex()
+    placeholder_codes = []
+    rows = []
+    for code, names in names_by_code.items():
+        name_keys = [name_blocking_key(name) for name in names]
+        if( is_placeholder_code(code) ):
+            placeholder_codes.append((code,name_keys))
+            continue
+        canonical_index = canonical_name(names,name_keys)
+        canonical = canonical_names[code] = names[canonical_index]
+        canonical_key = name_keys[canonical_index]
+        canonical_trigrams = None
+        for name, key in zip(names,name_keys):
+            if( not is_placeholder_name(name) ):
+                index.add(key,code)
+            if( key == canonical_key ):
+                similarity = 1.0
+            else:
+                if( canonical_trigrams is None ):
+                    canonical_trigrams = name_trigrams(canonical_key)
+                similarity = trigram_similarity(name_trigrams(key),canonical_trigrams)
+            rows.append((code,name,code,canonical,similarity))
+
+    linked = 0
+    for code, name_keys in placeholder_codes:
+        for name, key in zip(names_by_code[code],name_keys):
+            canonical_code = None
+            if( not is_placeholder_name(name) ):
+                canonical_code, similarity = index.find_code(key)
+            if( canonical_code is None ):
+                rows.append((code,name,code,name,1.0))
+            else:
+                rows.append((code,name,canonical_code,canonical_names[canonical_code],similarity))
+                linked = linked + 1
+    return rows, linked
+
+def reconcile_data():
+    '''Reconcile the names of agencies and vendors of the extracted database (see reconcile_names),
+       writing the canonical code and name of each name in the RECONCILED_NAMES table'''
+    db = sqlite3.connect(database_name,isolation_level=None)
+    db.execute("BEGIN")
+    db.execute("DROP TABLE IF EXISTS " + RECONCILED_NAMES)
+    db.execute("CREATE TABLE " + RECONCILED_NAMES + " (" + ", ".join([column_name + " " + column_type for column_name, column_type in RECONCILED_NAMES_SCHEMA]) + ")")
+    for kind, table_name, code_column, name_column, alternative_table_name, alternative_name_column in RECONCILED_ENTITIES:
+        start_time = time.time()
+        names_by_code = collections.OrderedDict()
+        for code, name in db.execute("SELECT " + code_column + ", " + name_column + " FROM " + table_name):
+            names_by_code[code] = [name]
+        for code, name in db.execute("SELECT " + code_column + ", " + alternative_name_column + " FROM " + alternative_table_name + " ORDER BY id"):
+            if( code in names_by_code ):
+                names_by_code[code].append(name)
+        rows, linked = reconcile_names(names_by_code)
+        db.executemany("INSERT INTO " + RECONCILED_NAMES + " VALUES ('" + kind + "', ?, ?, ?, ?, ?)",rows)
+        renamed = len([row for row in rows if row[0] == row[2] and row[1] == names_by_code[row[0]][0] and row[3] != row[1]])
+        print("Reconciled " + str(len(rows)) + " names of " + str(len(names_by_code)) + " " + table_name + " in " + "%.2f" % (time.time() - start_time) + " seconds: " + str(renamed) + " canonical names changed, " + str(linked) + " names of placeholder codes linked to a code")
+    db.execute("CREATE INDEX " + RECONCILED_NAMES + "_code_index ON " + RECONCILED_NAMES + " (kind, code)")
+    db.execute("CREATE INDEX " + RECONCILED_NAMES + "_canonical_code_index ON " + RECONCILED_NAMES + " (kind, canonical_code)")
+    db.execute("COMMIT")
+    db.close()
+
+def parse_amount(amount):
+    '''Convert an amount of the AVCP data to a float, or None if it is missing or not a number'''
+    if( amount is None ):
+        return None
+    amount = amount.strip()
+    if( ',' in amount ):
+        #italian notation (1.234,56)
+        amount = amount.replace('.','').replace(',','.')
+    try:
+        return float(amount)
+    except ValueError:
+        return None
+
+def aggregate_data():
+    '''Update the aggregate tables of AGGREGATES_SCHEMA: the months loaded in the database with a
+       sha1 different from the one of their last aggregation, or with contracts now published in
+       another month, are aggregated again, and the months no longer in the database are removed.
+       Each month is updated in its own transaction'''
+    db = sqlite3.connect(database_name,isolation_level=None)
+    db.create_function("parse_amount",1,parse_amount)
+    for statement in AGGREGATES_SCHEMA:
+        db.execute(statement)
+    loaded = {}
+    for pubblication_year, pubblication_month, sha1 in db.execute("SELECT pubblicationYear, pubblicationMonth, sha1 FROM " + SOURCE_FILES):
+        loaded[(pubblication_year,pubblication_month)] = sha1
+    aggregated = {}
+    for pubblication_year, pubblication_month, sha1 in db.execute("SELECT pubblicationYear, pubblicationMonth, sha1 FROM " + AGGREGATED_MONTHS):
+        aggregated[(pubblication_year,pubblication_month)] = sha1
+    changed_months = set([month for month in loaded if loaded[month] != aggregated.get(month)])
+    for month in db.execute(MOVED_CONTRACTS_MONTHS_QUERY):
+        if( month in loaded ):
+            changed_months.add(month)
+    changed_months = sorted(changed_months)
+    removed_months = sorted([month for month in aggregated if month not in loaded])
+
+    start_time = time.time()
+    for pubblication_year, pubblication_month in removed_months + changed_months:
+        month = dict(year=pubblication_year,month=pubblication_month)
+        db.execute("BEGIN")
+        for table_name in AGGREGATE_TABLES + [AGGREGATED_MONTHS]:
+            db.execute("DELETE FROM " + table_name + " WHERE pubblicationYear = :year AND pubblicationMonth = :month",month)
+        if( (pubblication_year,pubblication_month) in loaded ):
+            for statement in AGGREGATE_MONTH_STATEMENTS:
+                db.execute(statement,month)
+            db.execute("INSERT INTO " + AGGREGATED_MONTHS + " VALUES (:year, :month, :sha1, :aggregated_at)",
+                       dict(month,sha1=loaded[(pubblication_year,pubblication_month)],aggregated_at=datetime.datetime.now().isoformat()))
+        db.execute("COMMIT")
+        print_progress("Aggregated year " + str(pubblication_year) + " month " + str(pubblication_month))
+    end_progress()
+    db.close()
+    print("Aggregated " + str(len(changed_months)) + " changed months and removed " + str(len(removed_months)) + " months in " + "%.2f" % (time.time() - start_time) + " seconds, " + str(len(loaded) - len(changed_months)) + " months were already aggregated")
+
+def export_parquet_schema():
+    '''Schema of the parquet export: the amounts are typed, all the other columns are strings'''
+    fields = []
+    for column in EXPORT_COLUMNS:
+        if( column in EXPORT_AMOUNT_COLUMNS ):
+            fields.append(pyarrow.field(column,pyarrow.float64()))
+        else:
+            fields.append(pyarrow.field(column,pyarrow.string()))
+    return pyarrow.schema(fields)
+
+def write_parquet_rows(writer,schema,rows):
+    '''Write a chunk of exported rows to a parquet file as a row group'''
+    columns = []
+    for index, column in enumerate(EXPORT_COLUMNS):
+        if( column in EXPORT_AMOUNT_COLUMNS ):
+            values = [parse_amount(row[index]) for row in rows]
+        else:
+            values = [row[index] for row in rows]
+        columns.append(pyarrow.array(values,type=schema.field(column).type))
+    writer.write_table(pyarrow.Table.from_arrays(columns,schema=schema))
+
+def export_data():
+    '''Export the contracts with their public agency and winners to export_directory. The csv
+       export contains the same data of the openspending_freeze.yaml datafreeze dump, the parquet
+       export is partitioned in pubblicationYear=YYYY/pubblicationMonth=M directories and has
+       numeric amount columns. The rows are read and written in chunks of export_chunk_size,
+       and the new files replace the old ones only when the export is complete.'''
+    if( 'parquet' in export_formats and pyarrow is None ):
+        print("Error: the parquet export needs the pyarrow library (use --export_formats=csv to export only the csv)")
+        sys.exit(1)
+    if( not os.path.exists(export_directory) ):
+        os.makedirs(export_directory)
+
+    csv_filename = os.path.join(export_directory,export_basename + ".csv")
+    parquet_directory = os.path.join(export_directory,export_basename + ".parquet")
+    csv_file = None
+    if( 'csv' in export_formats ):
+        csv_file = open(csv_filename + ".part",'wb')
+        csv_writer = csv.writer(csv_file)
+        csv_writer.writerow(EXPORT_COLUMNS)
+    parquet_writer = None
+    parquet_partition = None
+    if( 'parquet' in export_formats ):
+        parquet_schema = export_parquet_schema()
+        if( os.path.exists(parquet_directory + ".part") ):
+            shutil.rmtree(parquet_directory + ".part")
+
+    db = sqlite3.connect(database_name)
+    cursor = db.execute(EXPORT_QUERY)
+    exported_rows = 0
+    while True:
+        rows = cursor.fetchmany(export_chunk_size)
+        if( len(rows) == 0 ):
+            break
+        exported_rows = exported_rows + len(rows)
+        print_progress("Exporting " + str(exported_rows) + " rows")
+        if( csv_file is not None ):
+            for row in rows:
+                csv_writer.writerow([value.encode('utf-8') if isinstance(value,unicode) else value for value in row[:len(EXPORT_COLUMNS)]])
+        if( 'parquet' in export_formats ):
+            #the rows are sorted by month, so a chunk is split in consecutive runs of the same month
+            start = 0
+            while( start < len(rows) ):
+                partition = rows[start][len(EXPORT_COLUMNS):]
+                end = start
+                while( end < len(rows) and rows[end][len(EXPORT_COLUMNS):] == partition ):
+                    end = end + 1
+                if( partition != parquet_partition ):
+                    if( parquet_writer is not None ):
+                        parquet_writer.close()
+                    partition_directory = os.path.join(parquet_directory + ".part","pubblicationYear=" + str(partition[0]),"pubblicationMonth=" + str(partition[1]))
+                    os.makedirs(partition_directory)
+                    parquet_writer = pyarrow.parquet.ParquetWriter(os.path.join(partition_directory,"part-0.parquet"),parquet_schema)
+                    parquet_partition = partition
+                write_parquet_rows(parquet_writer,parquet_schema,rows[start:end])
+                start = end
+    db.close()
+
+    if( csv_file is not None ):
+        csv_file.close()
+        os.rename(csv_filename + ".part",csv_filename)
+    if( 'parquet' in export_formats ):
+        if( parquet_writer is not None ):
+            parquet_writer.close()
+        if( not os.path.exists(parquet_directory + ".part") ):
+            os.makedirs(parquet_directory + ".part")
+        if( os.path.exists(parquet_directory) ):
+            shutil.rmtree(parquet_directory)
+        os.rename(parquet_directory + ".part",parquet_directory)
+    end_progress()
+    print("Exported " + str(exported_rows) + " rows to " + export_directory)
     
+def full_text_words(text):
+    '''FTS5 queries of the distinct words of text, one for each word (the punctuation and the
+       FTS5 operators in text are ignored)'''
+    words = []
+    for word in re.findall(r"\w+",text,re.UNICODE):
+        if( word.lower() not in [other.lower() for other in words] ):
+            words.append(word)
+    return ['"' + word + '"' for word in words]
+
+def full_text_word_query(query,index):
+    '''query for the word with the given index of a full text search (parameter :word0 and table
+       word0_names, :word1 and word1_names ...)'''
+    return query.replace('word_names','word' + str(index) + '_names').replace(':word',':word' + str(index))
+
+def full_text_search(db,text,limit=20):
+    '''Search the contracts matching all the words of text, each in their oggetto or in the
+       names of their agency or winners, returning at most limit rows with the SEARCH_COLUMNS of
+       the best ranked contracts. Only the contracts matching the most selective word are checked
+       for the other words, and only the contracts matching all the words are ranked'''
+    words = full_text_words(text)
+    if( len(words) == 0 ):
+        return []
+    documents = [db.execute(FULL_TEXT_WORD_DOCUMENTS_QUERY,dict(word=word,cap=full_text_selective_documents)).fetchone() for word in words]
+    counts = [subjects + names for subjects, names in documents]
+    if( min(counts) == 0 ):
+        return []
+    if( len(words) > 1 and min(counts) >= full_text_selective_documents ):
+        #no selective word: count the contracts of each word, up to the least count so far
+        counts = []
+        for word in words:
+            cap = min(counts) if len(counts) > 0 else -1
+            counts.append(db.execute(FULL_TEXT_WORD_COUNT_QUERY,dict(word=word,cap=cap)).fetchone()[0])
+    order = sorted(range(len(words)),key=lambda index: counts[index])
+    words = [words[index] for index in order]
+    named = [documents[index][1] > 0 for index in order]
+    if( len(words) > 1 ):
+        candidates = db.execute(FULL_TEXT_WORD_COUNT_QUERY,dict(word=words[0],cap=full_text_lookup_candidates)).fetchone()[0]
+    parameters = dict(limit=limit)
+    tables = []
+    conditions = []
+    scores = []
+    for index, word in enumerate(words):
+        parameters['word' + str(index)] = word
+        if( named[index] ):
+            tables.append(full_text_word_query('word_names AS (' + FULL_TEXT_WORD_NAMES_QUERY + ')',index))
+            scores.append(full_text_word_query(FULL_TEXT_WORD_SCORES_QUERY,index))
+        else:
+            scores.append(full_text_word_query(FULL_TEXT_SUBJECT_SCORES_QUERY,index))
+        if( index == 0 ):
+            continue
+        if( candidates < full_text_lookup_candidates ):
+            condition = FULL_TEXT_LOOKUP_CONDITION if named[index] else FULL_TEXT_SUBJECT_LOOKUP_CONDITION
+        else:
+            condition = FULL_TEXT_LIST_CONDITION if named[index] else FULL_TEXT_SUBJECT_LIST_CONDITION
+        conditions.append('(' + full_text_word_query(condition,index) + ')')
+    if( named[0] ):
+        tables.append('candidates AS (' + full_text_word_query(FULL_TEXT_WORD_CONTRACTS_QUERY,0) + ')')
+    else:
+        tables.append('candidates AS (' + full_text_word_query(FULL_TEXT_SUBJECT_CONTRACTS_QUERY,0) + ')')
+    if( len(words) == 1 ):
+        #a single word is ranked with the scores of its candidates
+        tables.append('ranked_contracts AS (SELECT id, score FROM candidates ORDER BY score LIMIT :limit)')
+    else:
+        tables.append('matches AS (' + FULL_TEXT_MATCHES_QUERY + ' WHERE ' + ' AND '.join(conditions) + ')')
+        tables.append('ranked_contracts AS (SELECT id, sum(score) AS score FROM (' + ' UNION ALL '.join(scores) + ') GROUP BY id ORDER BY score LIMIT :limit)')
+    query = 'WITH ' + ', '.join(tables) + ' ' + FULL_TEXT_RESULTS_QUERY
+    return db.execute(query,parameters).fetchall()
+
+def search_data():
+    '''Print the contracts found by full_text_search for the --query text'''
+    if( search_text is None ):
+        print("Error: search needs the text to search (use --query=TEXT)")
+        sys.exit(2)
+    db = sqlite3.connect(database_name)
+    if( not has_full_text_index(db) ):
+        print("Error: the database has no full text index (use extract --fts to build it)")
+        sys.exit(1)
+    start_time = time.time()
+    rows = full_text_search(db,search_text,search_limit)
+    seconds = time.time() - start_time
+    db.close()
+    for row in rows:
+        cig, score, pubblication_date, oggetto, importo, agency_code, agency_name, vendor_code, vendor_name = row
+        print(cig + " " + unicode(pubblication_date) + " | " + unicode(agency_name) + " | " + unicode(vendor_name) + " | " + unicode(importo) + " | " + unicode(oggetto))
+    print("Found " + str(len(rows)) + " contracts in " + "%.3f" % seconds + " seconds")
+
 def process(arg):
     if( arg == "download" ):
         download_data()
+    if( arg == "download_open" ):
+        download_data_active_tenders()
     if( arg == "indent" ):
         indent_data()
     if( arg == "push" ):
         push_data_to_github()
     if( arg == "extract" ):
         extract_data()
+    if( arg == "download_extract" ):
+        download_and_extract_data()
     if( arg == "dump_all_winners" ):
         dump_all_winners()
+    if( arg == "export" ):
+        export_data()
+    if( arg == "search" ):
+        search_data()
+    if( arg == "reconcile" ):
+        reconcile_data()
+    if( arg == "aggregate" ):
+        aggregate_data()
    
 def main():
     '''Main method for the scraper'''
         # parse command line options
+    global download_workers
+    global extract_processes
+    global incremental_extract
+    global pipelined_refresh
+    global export_formats
+    global force_download
+    global recent_months_to_refresh
+    global report_filename
+    global show_progress
+    global compression
+    global portal_result_cap
+    global full_text_index
+    global search_text
+    global search_limit
+    global database_buffer_max_size
+    global git_email
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "h", ["help"])
+        opts, args = getopt.getopt(sys.argv[1:], "h", ["help","download_workers=","force_download","recent_months=","extract_processes=","incremental","no_pipeline","export_formats=","report=","progress","compress=","result_cap=","fts","query=","limit=","buffer_size=","git_email="])
     except getopt.error:
         print("for help use --help")
         sys.exit(2)
@@ -490,14 +2324,77 @@ def main():
         if o in ("-h", "--help"):
             print(__doc__)
             sys.exit(0)
+        if o == "--download_workers":
+            download_workers = int(a)
+        if o == "--extract_processes":
+            extract_processes = int(a)
+        if o == "--incremental":
+            incremental_extract = True
+        if o == "--no_pipeline":
+            pipelined_refresh = False
+        if o == "--export_formats":
+            export_formats = a.split(",")
+        if o == "--force_download":
+            force_download = True
+        if o == "--recent_months":
+            recent_months_to_refresh = int(a)
+        if o == "--report":
+            report_filename = a
+        if o == "--progress":
+            show_progress = True
+        if o == "--compress":
+            if( a not in COMPRESSED_EXTENSIONS ):
+                print("Error: unknown compression " + a + " (use gzip or zstd)")
+                sys.exit(2)
+            if( a == 'zstd' and zstandard is None ):
+                print("Error: the zstd compression needs the zstandard library")
+                sys.exit(1)
+            compression = a
+        if o == "--result_cap":
+            portal_result_cap = int(a)
+        if o == "--fts":
+            full_text_index = True
+        if o == "--query":
+            search_text = a.decode('utf-8')
+        if o == "--limit":
+            search_limit = int(a)
+        if o == "--buffer_size":
+            database_buffer_max_size = int(a)
+        if o == "--git_email":
+            git_email = a
         if o == "--github_user":
             print("Using github user " + a)
         if o == "--github_password":
             print("Using github password " + a)
             
+    # download directly followed by extract is run as a single pipeline, the other stages
+    # are run in the given order
+    if( pipelined_refresh ):
+        stages = []
+        for arg in args:
+            if( arg == "extract" and len(stages) > 0 and stages[-1] == "download" ):
+                stages[-1] = "download_extract"
+            else:
+                stages.append(arg)
+        args = stages
+
     # process arguments
-    for arg in args:
-        process(arg) # process() is defined elsewhere
+    try:
+        for arg in args:
+            start_time = time.time()
+            previous_rss_mb, previous_children_rss_mb = peak_memory_mb()
+            process(arg) # process() is defined elsewhere
+            peak_rss_mb, peak_children_rss_mb = peak_memory_mb()
+            #the peaks are of the whole run so far, as ru_maxrss cannot be reset: the memory of the
+            #stage is how much it raised them (zero if it stayed below the peak of an earlier stage)
+            run_statistics['stages'].append(dict(stage=arg,seconds=time.time() - start_time,
+                                                 cumulative_peak_rss_mb=peak_rss_mb,
+                                                 cumulative_peak_children_rss_mb=peak_children_rss_mb,
+                                                 peak_rss_increase_mb=peak_rss_mb - previous_rss_mb,
+                                                 peak_children_rss_increase_mb=peak_children_rss_mb - previous_children_rss_mb))
+    finally:
+        if( report_filename is not None ):
+            write_run_report(report_filename)
         
     
 